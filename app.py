@@ -1,29 +1,25 @@
 from datetime import datetime as dt
+import os
+from uuid import uuid4
 import pandas as pd
 import numpy as np
 import streamlit as st
 from millify import prettify
-from data_processor import DataProcessor, OPERADORAS
+from background import JOB_POLL_SECONDS, JOB_WAIT_SECONDS, BackgroundExecutor
+from data_processor import (
+    DataProcessor,
+    OPERADORAS,
+    iter_term_chunks,
+    missing_term_columns,
+)
 from calculations import OnusCalculator
+from frequency_index import FrequencyIntervalIndex
+from instrumentation import metrics
+from map_layers import MapLayerCache
+from term_store import SQLiteTermStore, TermStore
 from ui_components import UIComponents
 import toml
 
-EXPECTED_COLUMNS = [
-    "AnoBase",
-    "Entidade",
-    "NumTermo",
-    "AnoTermo",
-    "UF",
-    "AreaPrestacao",
-    "AreaExclusao",
-    "MunicipioExclusao",
-    "FrequenciaInicial",
-    "FrequenciaFinal",
-    "FrequenciaCentral",
-    "Banda",
-    "Tipo",
-]
-
 COLUMN_CONFIG = {
     "AnoBase": st.column_config.NumberColumn(
         "Ano - Base",
@@ -109,6 +105,12 @@ COLUMN_CONFIG = {
         help="📜Banda",
         disabled=True,
     ),
+    "BW_Freq": st.column_config.NumberColumn(
+        "Banda/Frequência",
+        width=None,
+        help="📜Banda / Frequência Central",
+        disabled=True,
+    ),
     "Tipo": st.column_config.TextColumn(
         "Tipo",
         width=None,
@@ -130,28 +132,126 @@ COLUMN_CONFIG = {
 }
 
 
+@st.cache_resource
+def get_data_processor():
+    """Reference data and indexes, loaded once and shared by every session"""
+    return DataProcessor().warm_up()
+
+
+@st.cache_resource
+def get_onus_calculator():
+    """Calculator shared by every session"""
+    return OnusCalculator(get_data_processor())
+
+
+@st.cache_resource
+def get_map_layers():
+    """Simplified state outlines, shared by every session"""
+    return MapLayerCache()
+
+
+@st.cache_resource
+def get_background_executor():
+    """Threads running the heavy stages of every session"""
+    return BackgroundExecutor()
+
+
+def new_term_store():
+    """Term store of a session, persisted in the SQLite file ONUS_TERMS_DB if set"""
+    path = os.environ.get("ONUS_TERMS_DB")
+    return SQLiteTermStore(path, owner=session_owner()) if path else TermStore()
+
+
+def session_owner():
+    """
+    Owner of the session's terms in ONUS_TERMS_DB, kept in the URL so that
+    reloading the page finds the same terms and other sessions never see them
+    """
+    if not (owner := st.query_params.get("sessao")):
+        owner = st.query_params["sessao"] = uuid4().hex
+    return owner
+
+
+if metrics.enabled:
+    metrics.start_run()
+
 # Initialize components
-data_processor = DataProcessor()
-onus_calculator = OnusCalculator(data_processor)
 ui = UIComponents()
 
 # Setup page
 ui.setup_page()
-# Create tabs
-aba1, aba2 = st.tabs(["Cadastro/Carregamento", "Cálculo do Ônus"])
 
-if "df" not in st.session_state:
-    st.session_state.df = pd.DataFrame(columns=EXPECTED_COLUMNS, dtype="string")
+# Shared components, loaded after set_page_config since the first load shows a spinner
+data_processor = get_data_processor()
+onus_calculator = get_onus_calculator()
+# Create tabs
+aba1, aba2, aba3 = st.tabs(["Cadastro/Carregamento", "Cálculo do Ônus", "Mapas"])
+
+if "terms" not in st.session_state:
+    st.session_state.terms = new_term_store()
+if "jobs" not in st.session_state:
+    st.session_state.jobs = get_background_executor().session()
+
+
+def job_result(slot, key, func, *args, **kwargs):
+    """
+    Result of func(*args, **kwargs), computed in the background and keyed by
+    the fingerprint of its inputs
+
+    A job superseded by other inputs is cancelled. If the job does not end
+    within JOB_WAIT_SECONDS, the previous result of the slot is returned
+    meanwhile and watch_jobs reruns the app once it ends. The timings of the
+    job are added to those of the first rerun collecting its result, and its
+    error is shown in the app.
+
+    Args:
+        slot: Name of the stage
+        key: Hashable fingerprint of the inputs
+
+    Returns:
+        tuple: (key of the result, result, whether it is the result of key).
+            The key and result are None if the slot has no result yet
+    """
+    job = st.session_state.jobs.submit(slot, key, func, *args, **kwargs)
+    if not job.wait(JOB_WAIT_SECONDS):
+        return *(st.session_state.jobs.previous(slot) or (None, None)), False
+    metrics.add_run_timings(job.take_timings())
+    try:
+        return key, job.result(), True
+    except Exception as e:
+        st.error(f"Erro no cálculo: {e}", icon=":material/error:")
+        return None, None, True
+
+
+def calculate_base_year_onus(expand, fingerprint, year, *args):
+    """
+    ônus of a term, from OnusCalculator.calculate_onus over the expanded rows
+    of its base year
+
+    Args:
+        expand: Function of the DataProcessor returning the rows of the terms
+            of the base year, from the snapshot of the term store
+        fingerprint: Identifies those rows
+        year: Base year
+        *args: The other arguments of calculate_onus, up to rol_uf
+    """
+    return onus_calculator.calculate_onus(
+        year, *args, expand(data_processor), fingerprint=fingerprint
+    )
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def watch_jobs():
+    """Rerun the app once the background jobs of the session end"""
+    if not st.session_state.jobs.pending():
+        st.rerun()
 
 
 @st.fragment
 def update_df(df):
     """Display data in the data editor"""
-    before_df = st.session_state.df.astype("string").copy()
-    st.session_state.df = pd.concat(
-            [st.session_state.df, df.astype("string")], ignore_index=True
-        ).drop_duplicates(ignore_index=True).astype("string")
-    if st.session_state.df.equals(before_df):
+    added, _ = st.session_state.terms.add(df)
+    if not added:
         st.warning("Termo já adicionado!", icon="⚠️")
     else:
         st.success("Termo adicionado com sucesso!", icon="✅")
@@ -159,45 +259,62 @@ def update_df(df):
 
 @st.fragment
 @st.dialog("⚠️Já existem dados inseridos.⚠️")
-def confirm_action(uploaded_df):
+def confirm_action():
     cols = st.columns(2)
     with cols[0]:
         if st.button("Concatenar dados do arquivo"):
-            update_df(uploaded_df)
+            ingest_csv()
             st.rerun()
 
     with cols[1]:
         if st.button("Substituir dados existentes pelos dados do arquivo"):
-            st.session_state.df = pd.DataFrame(columns=EXPECTED_COLUMNS)
-            update_df(uploaded_df)
+            ingest_csv(replace=True)
             st.rerun()
 
 
+def ingest_csv(replace=False):
+    """
+    Add the terms of the uploaded CSV chunk by chunk, skipping the rows already
+    registered or repeated in the file
+    """
+    if replace:
+        st.session_state.terms.clear()
+    n_new = n_rows = 0
+
+    progress = st.progress(0.0, text="Carregando termos...")
+    for df_chunk in iter_term_chunks(uploaded_file):
+        added, _ = st.session_state.terms.add(df_chunk)
+        n_new += added
+        n_rows += len(df_chunk)
+        progress.progress(
+            min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0),
+            text=f"Carregando termos... {n_rows} linhas lidas",
+        )
+    progress.empty()
+
+    if n_new < n_rows:
+        st.warning(
+            f"{n_rows - n_new} termos já adicionados foram ignorados.", icon="⚠️"
+        )
+    if n_new:
+        st.success(f"{n_new} termos adicionados com sucesso!", icon="✅")
+
+
 def input_csv_data():
     """Read CSV data from file"""
 
-    # Read the CSV file
-    uploaded_df = pd.read_csv(uploaded_file, dtype="string").fillna("")
-
-    if missing_columns := [
-        col for col in EXPECTED_COLUMNS if col not in uploaded_df.columns
-    ]:
+    # Check the header before parsing the rows
+    if missing_columns := missing_term_columns(uploaded_file):
         st.error(
             f"O arquivo CSV não contém as seguintes colunas obrigatórias: {', '.join(missing_columns)}"
         )
+    elif not st.session_state.terms.empty:
+        confirm_action()
     else:
-        # Keep only the expected columns
-        uploaded_df = uploaded_df.loc[:, EXPECTED_COLUMNS]
-
-        if not st.session_state.df.empty:
-            confirm_action(uploaded_df)
-        else:
-            update_df(uploaded_df)
+        ingest_csv()
 
 def edit_df():
-    for idx in st.session_state["edited_df"]["deleted_rows"]:
-        st.session_state.df.drop(idx, inplace=True)
-    st.session_state.df.reset_index(drop=True, inplace=True)
+    st.session_state.terms.delete(st.session_state["edited_df"]["deleted_rows"])
 
 uploaded_file = st.sidebar.file_uploader(
     "Carregar dados de um arquivo CSV",
@@ -207,6 +324,8 @@ uploaded_file = st.sidebar.file_uploader(
 if uploaded_file is not None:
     st.sidebar.button("Carregar dados do arquivo CSV", on_click=input_csv_data)
 
+ui.render_shared_memory(data_processor.memory_usage())
+
 with aba1:
     with st.expander("Adicionar termos manualmente", expanded=True):
         first_row = st.columns(7)
@@ -289,10 +408,10 @@ with aba1:
                 else:
                     update_df(df)
 
-    if not st.session_state.df.empty:
+    if not st.session_state.terms.empty:
         with st.expander("Tabela de Termos Cadastrados (Editável)", expanded=True):
             st.data_editor(
-                st.session_state.df,
+                st.session_state.terms.df,
                 column_config=COLUMN_CONFIG,
                 use_container_width=True,
                 hide_index=True,
@@ -302,26 +421,47 @@ with aba1:
             )
             
 
-    # Generate final dataframe for all terms
-    if not st.session_state.df.empty:
-        df_termos = data_processor.gerar_tabela_final(st.session_state.df)
+    # Generate final dataframe for all terms, in the background
+    df_termos = None
+    if not st.session_state.terms.empty:
+        # The job expands the terms as they are now, whatever the next reruns
+        # change meanwhile
+        fingerprint_termos, expandir_termos = st.session_state.terms.snapshot()
+        _, df_termos, termos_atuais = job_result(
+            "tabela",
+            (fingerprint_termos, data_processor.data_fingerprint),
+            expandir_termos,
+            data_processor,
+        )
+        if not termos_atuais:
+            ui.render_pending("a tabela de municípios", df_termos is not None)
+    if df_termos is not None:
         with st.expander("Tabela de Municípios", expanded=True):
             st.dataframe(
                 df_termos, use_container_width=True, column_config=COLUMN_CONFIG
             )
+        with st.expander("Conflitos de Frequência", expanded=False):
+            if st.toggle("Verificar sobreposição de faixas", key="checkConflitos"):
+                df_conflitos = FrequencyIntervalIndex(df_termos).conflicting_pairs()
+                if df_conflitos.empty:
+                    st.success("Nenhuma sobreposição de faixas entre os termos.")
+                else:
+                    st.warning(
+                        f"{len(df_conflitos)} pares de termos com faixas sobrepostas "
+                        "no mesmo município."
+                    )
+                    st.dataframe(
+                        df_conflitos, use_container_width=True, hide_index=True
+                    )
 
 with aba2:
-    if not st.session_state.df.empty:
+    if not st.session_state.terms.empty:
         col_a, col_b = st.columns(2, border=True)
         with col_a:
             st.subheader("Dados para o cálculo")
-            # Prepare data for calculation
-            df_termos["popMun"] = df_termos["popMun"].astype("int")
-            df_termos["popUF"] = df_termos["popUF"].astype("int")
-            df_termos["coefPop"] = df_termos["popMun"] / df_termos["popUF"]
-            # Render ônus controls
+            # Render ônus controls, which only need the columns of the terms
             year, entity, state, term, term_year, rol = ui.render_onus_controls(
-                df_termos
+                st.session_state.terms.df
             )
 
             # Validate inputs
@@ -330,52 +470,94 @@ with aba2:
             )
 
             if is_valid:
-                # Calculate onus
-                onus, df_factors, population_total = onus_calculator.calculate_onus(
-                    year, entity, state, term, term_year, rol, df_termos
+                # Calculate onus in the background, over the expanded rows of
+                # the base year only
+                fingerprint_ano, expandir_ano = st.session_state.terms.snapshot(
+                    AnoBase=str(year)
                 )
-                is_valid = is_valid and not df_factors.empty
-
-                with col_b:
-                    st.subheader("Estatísticas do cálculo")
-                    rowa = st.columns(3)
-                    rowa[0].metric("Total de municípios", value=len(df_factors))
-                    if is_valid:
-                        rowa[1].metric("População total", value=prettify(population_total))
-                        rowb = st.columns(3)
-                        rowb[0].metric(
-                            label=f"Ônus Termo: {term}/{term_year}",
-                            value=f"R$ {prettify(np.round(onus, 2).item())}",
-                        )
-                        rowb[1].metric(
-                            "Ônus médio por município",
-                            value=f"R$ {np.round(onus / len(df_factors), 2).item()}",
-                        )
-                        rowb[2].metric(
-                            "Ônus por habitante",
-                            value=f"R$ {prettify(np.round(onus / population_total, 5).item())}",
+                key_onus, resultado, onus_atual = job_result(
+                    "onus",
+                    (
+                        year,
+                        entity,
+                        state,
+                        term,
+                        term_year,
+                        rol,
+                        (fingerprint_ano, data_processor.data_fingerprint),
+                    ),
+                    calculate_base_year_onus,
+                    expandir_ano,
+                    (fingerprint_ano, data_processor.data_fingerprint),
+                    year,
+                    entity,
+                    state,
+                    term,
+                    term_year,
+                    rol,
+                )
+                if not onus_atual:
+                    ui.render_pending("o ônus", resultado is not None)
+                if resultado is None:
+                    is_valid = False
+                else:
+                    # Labels follow the inputs of the result shown
+                    year, entity, state, term, term_year, rol, _ = key_onus
+                    onus, df_factors, population_total = resultado
+                    is_valid = not df_factors.empty
+
+                    with col_b:
+                        st.subheader("Estatísticas do cálculo")
+                        if is_valid and pd.isna(onus):
+                            st.warning(
+                                f"Ônus indefinido: há municípios do termo sem dados de população em {year}.",
+                                icon="⚠️",
+                            )
+                        # Figures left undefined by missing population data
+                        # are neither shown nor exported
+                        metrics_dict = {"Total de municípios": len(df_factors)}
+                        if is_valid and not pd.isna(population_total):
+                            metrics_dict["População total"] = prettify(
+                                population_total
+                            )
+                        if is_valid and not pd.isna(onus):
+                            metrics_dict[f"Ônus Termo: {term}/{term_year}"] = (
+                                f"R$ {prettify(np.round(onus, 2).item())}"
+                            )
+                            metrics_dict["Ônus médio por município"] = (
+                                f"R$ {np.round(onus / len(df_factors), 2).item()}"
+                            )
+                            if not pd.isna(population_total):
+                                metrics_dict["Ônus por habitante"] = (
+                                    f"R$ {prettify(np.round(onus / population_total, 5).item())}"
+                                )
+                        labels = list(metrics_dict)
+                        rowa = st.columns(3)
+                        for col, label in zip(rowa, labels[:2]):
+                            col.metric(label, value=metrics_dict[label])
+                        if len(labels) > 2:
+                            rowb = st.columns(3)
+                            for col, label in zip(rowb, labels[2:]):
+                                col.metric(label, value=metrics_dict[label])
+
+                        # Add metrics as a dataframe
+                        metrics_dict = {
+                            label: [value] for label, value in metrics_dict.items()
+                        }
+                        st.dataframe(
+                            pd.DataFrame(metrics_dict),
+                            use_container_width=True,
+                            hide_index=True,
                         )
 
-                    # Add metrics as a dataframe
-                    metrics_dict = {
-                        "Total de municípios": [len(df_factors)],
-                        "População total": [prettify(population_total)],
-                        f"Ônus Termo: {term}/{term_year}": [f"R$ {prettify(np.round(onus, 2).item())}"],
-                        "Ônus médio por município": [f"R$ {np.round(onus / len(df_factors), 2).item()}"],
-                        "Ônus por habitante": [f"R$ {prettify(np.round(onus / population_total, 5).item())}"],
-                    }
-                    st.dataframe(
-                        pd.DataFrame(metrics_dict),
-                        use_container_width=True,
-                        hide_index=True,
-                    )
-
             else:
                 st.error(error_message)
         if is_valid:
             # Render result
             with st.expander("Fatores por Município", expanded=True):
-                # Format the dataframe for display
+                # Format a copy for display, the job keeps the result for the
+                # next reruns
+                df_factors = df_factors.copy()
                 df_factors["fatorFreq"] = df_factors["fatorFreq"].apply(
                     lambda x: f"{x:.4f}"
                 )
@@ -388,12 +570,24 @@ with aba2:
 
             # Display filtered terms with ability to delete rows
             with st.expander("Termos para a UF selecionada", expanded=False):
-                df_terms = st.session_state.df[
-                    (st.session_state.df["UF"] == state)
-                    & (st.session_state.df["AnoBase"] == str(year))
-                ]
+                df_terms = st.session_state.terms.select(UF=state, AnoBase=str(year))
                 st.dataframe(df_terms, column_config=COLUMN_CONFIG, hide_index=True)
 
+with aba3:
+    if df_termos is not None:
+        term_map, year_map, state_map, area_map, mun_codes_map = (
+            ui.render_map_controls(df_termos)
+        )
+        ui.render_map(get_map_layers(), state_map, mun_codes_map)
+    else:
+        ui.render_map_controls(None)
+
+if st.session_state.jobs.pending():
+    watch_jobs()
+
+if metrics.enabled:
+    ui.render_metrics(metrics)
+
 def get_version():
     pyproject = toml.load("pyproject.toml")
     return pyproject.get("project", {}).get("version", "unknown")
@@ -0,0 +1,203 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from instrumentation import metrics
+
+# Threads shared by every session
+JOB_WORKERS = 2
+# Seconds a rerun waits for a job before showing the previous result instead
+JOB_WAIT_SECONDS = 0.3
+# Seconds between the checks for the end of the jobs in flight
+JOB_POLL_SECONDS = 0.5
+
+
+class Job:
+    """A computation submitted to a JobSlots slot, identified by its input key"""
+
+    def __init__(self, key, func, args, kwargs):
+        """
+        Args:
+            key: Hashable fingerprint of the inputs of the computation
+            func: Function computing the result
+            args: Positional arguments of func
+            kwargs: Keyword arguments of func
+        """
+        self.key = key
+        self.future = Future()
+        self._call = (func, args, kwargs)
+        self._timings = []
+
+    def done(self):
+        """Whether the job finished, failed or was cancelled"""
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to end
+
+        Args:
+            timeout: Seconds to wait, None to wait until it ends
+
+        Returns:
+            bool: Whether the job ended
+        """
+        return bool(wait([self.future], timeout).done)
+
+    def result(self):
+        """Result of a finished job, raising its exception if it failed"""
+        return self.future.result()
+
+    def take_timings(self):
+        """
+        Measurements of the instrumented functions called by the job, returned
+        once, so they are only added to the first run collecting the result
+
+        Returns:
+            list: (name, seconds, rows) of each call, as from
+                MetricsRegistry.run_timings
+        """
+        timings, self._timings = self._timings, []
+        return timings
+
+
+class _Slot:
+    """Jobs of a slot: the latest submitted and the one executing"""
+
+    __slots__ = ("current", "running", "result")
+
+    def __init__(self):
+        self.current = None
+        self.running = None
+        self.result = None
+
+
+class JobSlots:
+    """
+    Background jobs of one session, one slot per stage of the app
+
+    Each slot keeps the job of the latest inputs, keyed by their fingerprint.
+    Submitting the key of that job returns it, in flight or done, and another
+    key supersedes it: a superseded job that has not started is cancelled, and
+    one already executing runs to the end but its result is only kept as the
+    previous result of the slot. The jobs of a slot run one at a time, so the
+    per-session caches they update are never used by two threads.
+    """
+
+    def __init__(self, executor):
+        """
+        Args:
+            executor: Executor running the jobs, usually shared by every
+                session
+        """
+        self._executor = executor
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def submit(self, slot, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the background, unless the slot already
+        has a job for key
+
+        Args:
+            slot: Name of the stage, e.g. "tabela"
+            key: Hashable fingerprint of the inputs
+
+        Returns:
+            Job: The job of key
+        """
+        with self._lock:
+            state = self._slots.setdefault(slot, _Slot())
+            job = state.current
+            if job is not None and job.key == key and not job.future.cancelled():
+                return job
+            if job is not None:
+                job.future.cancel()
+
+            job = state.current = Job(key, func, args, kwargs)
+            # Otherwise started when the job executing ends
+            if state.running is None:
+                self._start(state, job)
+        return job
+
+    def previous(self, slot):
+        """
+        Last successful result of a slot, shown while its current job is in
+        flight
+
+        Returns:
+            tuple: (key, result), or None if no job of the slot succeeded
+        """
+        with self._lock:
+            state = self._slots.get(slot)
+            return state.result if state is not None else None
+
+    def pending(self):
+        """Jobs submitted and not ended yet"""
+        with self._lock:
+            return [
+                state.current
+                for state in self._slots.values()
+                if state.current is not None and not state.current.done()
+            ]
+
+    def cancel(self):
+        """Cancel the jobs that have not started"""
+        with self._lock:
+            for state in self._slots.values():
+                if state.current is not None:
+                    state.current.future.cancel()
+
+    def _start(self, state, job):
+        """Hand a job to the executor. Called with the lock held"""
+        state.running = job
+        self._executor.submit(self._run, state, job)
+
+    def _run(self, state, job):
+        """Execute a job, then start the latest job of its slot if waiting"""
+        try:
+            if job.future.set_running_or_notify_cancel():
+                func, args, kwargs = job._call
+                if metrics.enabled:
+                    metrics.start_run()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    # Raised by Job.result to whoever collects it
+                    job._timings = metrics.run_timings()
+                    job.future.set_exception(e)
+                else:
+                    job._timings = metrics.run_timings()
+                    with self._lock:
+                        state.result = (job.key, result)
+                    job.future.set_result(result)
+        finally:
+            job._call = None
+            with self._lock:
+                state.running = None
+                waiting = state.current
+                if waiting is not job and not waiting.done():
+                    self._start(state, waiting)
+
+
+class BackgroundExecutor:
+    """
+    Thread pool running the heavy stages of the app off the script thread, so
+    a rerun never waits for the computation of inputs it has moved past
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS):
+        """
+        Args:
+            max_workers: Number of threads
+        """
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="onus-job"
+        )
+
+    def session(self):
+        """New JobSlots of a session, running on this pool"""
+        return JobSlots(self._pool)
+
+    def shutdown(self):
+        """Stop the threads once the submitted jobs end"""
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,171 @@
+import argparse
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from calculations import TERM_KEYS, OnusCalculator
+from data_processor import DataProcessor, iter_term_chunks, missing_term_columns
+
+ROL_COLUMNS = ["Entidade", "UF", "ROL"]
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+
+def read_terms(path):
+    """
+    Read a terms CSV in the format accepted by the app's upload
+
+    Args:
+        path: Path of the CSV file with the EXPECTED_COLUMNS
+
+    Returns:
+        DataFrame: Distinct terms with the expected columns, as strings
+    """
+    if missing_columns := missing_term_columns(path):
+        raise ValueError(
+            f"O arquivo CSV não contém as seguintes colunas obrigatórias: {', '.join(missing_columns)}"
+        )
+
+    return pd.concat(
+        [df_chunk.drop_duplicates() for df_chunk in iter_term_chunks(path)],
+        ignore_index=True,
+    ).drop_duplicates(ignore_index=True)
+
+
+def read_rol(path):
+    """
+    Read the ROL table, one row per entity and state
+
+    Args:
+        path: Path of a CSV file with the columns Entidade, UF and ROL
+
+    Returns:
+        dict: Mapping of (entity, state) to the ROL of the state
+    """
+    df_rol = pd.read_csv(path, dtype={"Entidade": "string", "UF": "string"})
+
+    if missing_columns := [col for col in ROL_COLUMNS if col not in df_rol.columns]:
+        raise ValueError(
+            f"A tabela de ROL não contém as seguintes colunas obrigatórias: {', '.join(missing_columns)}"
+        )
+    if df_rol.duplicated(["Entidade", "UF"]).any():
+        raise ValueError(
+            "A tabela de ROL tem mais de um valor para a mesma Entidade e UF"
+        )
+
+    rol = pd.to_numeric(df_rol["ROL"], errors="raise")
+    return dict(zip(zip(df_rol["Entidade"], df_rol["UF"]), rol))
+
+
+def calculate_portfolio(
+    data_processor, calculator, df_terms, rol_by_entity_uf, max_workers=1
+):
+    """
+    Calculate the ônus of every term of a portfolio
+
+    Terms whose Banda or FrequenciaCentral is not a number are reported on
+    stderr and left out.
+
+    Args:
+        data_processor: DataProcessor with the reference data
+        calculator: OnusCalculator
+        df_terms: DataFrame of terms, from read_terms
+        rol_by_entity_uf: Mapping of (entity, state) to ROL, from read_rol
+        max_workers: Number of processes. Above 1, the (Entidade, UF) shards
+            are calculated in parallel and their timings printed
+
+    Returns:
+        tuple: (terms_dataframe, factors_dataframe), as in
+            OnusCalculator.calculate_all_onus
+    """
+    is_numeric = (
+        pd.to_numeric(df_terms["Banda"], errors="coerce").notna()
+        & pd.to_numeric(df_terms["FrequenciaCentral"], errors="coerce").notna()
+    )
+    df_invalid = df_terms.loc[~is_numeric, ["Entidade", "UF", "NumTermo"]]
+    for term in df_invalid.itertuples(index=False):
+        print(
+            f"Termo {term.NumTermo} ({term.Entidade}/{term.UF}) ignorado: "
+            "Banda e FrequenciaCentral devem ser numéricas",
+            file=sys.stderr,
+        )
+
+    df_data = data_processor.gerar_tabela_final(df_terms[is_numeric])
+    if max_workers <= 1:
+        return calculator.calculate_all_onus(df_data, rol_by_entity_uf)
+
+    df_onus, df_factors, df_timings = calculator.calculate_all_onus_parallel(
+        df_data, rol_by_entity_uf, max_workers
+    )
+    print(df_timings.to_string(index=False))
+    return df_onus, df_factors
+
+
+def write_table(df, path):
+    """Write a table as CSV or Parquet, according to the file extension"""
+    if path.suffix == ".parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def main(argv=None):
+    """Run the batch calculation from the command line"""
+    parser = argparse.ArgumentParser(
+        description="Cálculo do ônus de todos os termos de um arquivo CSV"
+    )
+    parser.add_argument(
+        "termos", type=Path, help="CSV de termos, como no upload do app"
+    )
+    parser.add_argument(
+        "rol", type=Path, help="CSV com as colunas Entidade, UF e ROL"
+    )
+    parser.add_argument(
+        "-o", "--saida", type=Path, default=Path("."), help="Pasta dos resultados"
+    )
+    parser.add_argument("-f", "--formato", choices=OUTPUT_FORMATS, default="csv")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Processos para calcular as Entidades/UFs em paralelo",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        df_terms = read_terms(args.termos)
+        rol_by_entity_uf = read_rol(args.rol)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    data_processor = DataProcessor()
+    calculator = OnusCalculator(data_processor)
+    df_onus, df_factors = calculate_portfolio(
+        data_processor, calculator, df_terms, rol_by_entity_uf, args.workers
+    )
+
+    df_missing_rol = df_onus.loc[df_onus["ROL"].isna(), ["Entidade", "UF"]]
+    for key in df_missing_rol.drop_duplicates().itertuples(index=False):
+        print(f"ROL não informado para {key.Entidade}/{key.UF}", file=sys.stderr)
+
+    df_missing_pop = df_onus.loc[
+        df_onus["onusTermo"].isna() & df_onus["ROL"].notna(), TERM_KEYS
+    ]
+    for key in df_missing_pop.itertuples(index=False):
+        print(
+            f"Ônus indefinido para {key.Entidade}/{key.UF} termo "
+            f"{key.NumTermo}/{key.AnoTermo}: municípios sem população em "
+            f"{key.AnoBase}",
+            file=sys.stderr,
+        )
+
+    args.saida.mkdir(parents=True, exist_ok=True)
+    for name, df in (("onus_termos", df_onus), ("fatores_municipios", df_factors)):
+        path = args.saida / f"{name}.{args.formato}"
+        write_table(df, path)
+        print(f"{path}: {len(df)} linhas")
+
+
+if __name__ == "__main__":
+    main()
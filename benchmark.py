@@ -0,0 +1,580 @@
+import argparse
+from datetime import datetime as dt
+import json
+from pathlib import Path
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from calculations import TERM_KEYS, OnusCalculator
+from data_processor import AREA_PREST, BASE_POP, OPERADORAS, DataProcessor
+
+AREA_TYPES = ["toda_uf", "setores"]
+# Synthetic portfolios of the pipeline benchmark, from a single operator to a
+# national portfolio
+SCENARIOS = [
+    {"entidades": 1, "termos_por_uf": 5, "areas": "toda_uf", "exclusoes": 0},
+    {"entidades": 1, "termos_por_uf": 5, "areas": "setores", "exclusoes": 0},
+    {"entidades": 3, "termos_por_uf": 20, "areas": "toda_uf", "exclusoes": 3},
+    {"entidades": 3, "termos_por_uf": 20, "areas": "setores", "exclusoes": 3},
+    {"entidades": 5, "termos_por_uf": 40, "areas": "toda_uf", "exclusoes": 10},
+    {"entidades": 5, "termos_por_uf": 40, "areas": "setores", "exclusoes": 10},
+]
+SCENARIO_STATES = ("MG", "SP", "BA", "AM", "DF", "RS")
+
+
+def _loop_municipality_factors(df_term, df_other_terms, pop_total, rol_uf):
+    """Original per-municipality loop, kept as the baseline for the benchmark"""
+    mun_codes = list(df_term["codMun"].unique())
+
+    df_factors = pd.DataFrame()
+    total_onus = 0
+
+    for mun_code in mun_codes:
+        pop_mun = df_term[df_term["codMun"] == mun_code]["popMun"].unique()
+        factor_pop = pop_mun / pop_total
+
+        freq_numerator = (
+            df_term[df_term["codMun"] == mun_code]["BW_Freq"].unique().sum()
+        )
+        freq_denominator = freq_numerator
+
+        other_terms_mun = df_other_terms[df_other_terms["codMun"] == mun_code]
+        if not other_terms_mun.empty:
+            freq_denominator += other_terms_mun["BW_Freq"].unique().sum()
+
+        factor_freq = freq_numerator / freq_denominator if freq_denominator > 0 else 0
+
+        mun_onus = factor_freq * factor_pop * 0.02 * rol_uf
+        total_onus += mun_onus[0] if isinstance(mun_onus, pd.Series) else mun_onus
+
+        mun_name = df_term[df_term["codMun"] == mun_code]["Municipio"].unique()
+        df_factor_row = pd.DataFrame(
+            {
+                "Municipio": mun_name,
+                "codMun": mun_code,
+                "fatorFreq": factor_freq,
+                "fatorPop": factor_pop,
+                "onusMunicipio": mun_onus,
+            }
+        )
+        df_factors = pd.concat([df_factors, df_factor_row])
+
+    return df_factors, total_onus
+
+
+def make_factor_inputs(n_municipalities, n_terms, seed=0):
+    """
+    Build synthetic term / other terms frames as seen by the factor engine
+
+    Args:
+        n_municipalities: Number of municipalities covered by every term
+        n_terms: Number of competing terms in the same entity and UF
+        seed: Seed for the random generator
+
+    Returns:
+        tuple: (df_term, df_other_terms, pop_total)
+    """
+    rng = np.random.default_rng(seed)
+    df_mun = pd.DataFrame(
+        {
+            "Municipio": [f"Municipio {i}" for i in range(n_municipalities)],
+            "codMun": [str(3100000 + i) for i in range(n_municipalities)],
+            "popMun": rng.integers(1_000, 2_000_000, n_municipalities),
+        }
+    )
+
+    def term_rows(bandwidth, frequency):
+        return df_mun.assign(BW_Freq=bandwidth / frequency)
+
+    df_term = term_rows(20.0, 3510.0)
+    df_other_terms = pd.concat(
+        [
+            term_rows(
+                float(rng.choice([5, 10, 20])),
+                float(rng.choice([710, 860, 1810, 2110, 2510, 3510])),
+            )
+            for _ in range(n_terms)
+        ],
+        ignore_index=True,
+    )
+
+    return df_term, df_other_terms, df_mun["popMun"].sum()
+
+
+def _loop_gerar_tabela_final(data_processor, df):
+    """Original per-term gerar_tabela_final, kept as the baseline for the benchmark"""
+    final_rows = []
+    for row in df.itertuples():
+        tabela_com_areas_excluidas = data_processor.exclude_areas_from_df(
+            row.AreaPrestacao, row.AnoBase, row.UF, row.AreaExclusao
+        )
+        tabela_final = data_processor.exclude_cities_from_df(
+            tabela_com_areas_excluidas, row.MunicipioExclusao
+        )
+        tabela_final = tabela_final.assign(
+            AreaExclusao=row.AreaExclusao,
+            MunicipioExclusao=row.MunicipioExclusao,
+            AnoBase=str(row.AnoBase),
+            Entidade=row.Entidade,
+            NumTermo=row.NumTermo,
+            AnoTermo=row.AnoTermo,
+            FrequenciaInicial=row.FrequenciaInicial,
+            FrequenciaFinal=row.FrequenciaFinal,
+            FrequenciaCentral=row.FrequenciaCentral,
+            Banda=row.Banda,
+            Tipo=row.Tipo,
+        )
+        final_rows.append(tabela_final)
+
+    return pd.concat(final_rows, ignore_index=True).drop_duplicates()
+
+
+def make_terms(data_processor, n_terms, year=2023, states=("MG", "SP", "BA"), seed=0):
+    """
+    Build a synthetic portfolio of terms in the schema of the uploaded CSVs
+
+    Service areas, exclusion areas and excluded municipalities are drawn from
+    the real reference tables.
+
+    Returns:
+        DataFrame: n_terms rows with string columns
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_terms):
+        state = str(rng.choice(states))
+        area = str(rng.choice(data_processor.get_service_areas_for_state(state)))
+        exclusion_options = data_processor.get_exclusion_areas(year, state, area)
+        exclusions = list(
+            rng.choice(
+                exclusion_options,
+                min(len(exclusion_options), rng.integers(0, 3)),
+                replace=False,
+            )
+        )
+        remaining = data_processor.exclude_areas_from_df(
+            area, year, state, ", ".join(exclusions)
+        )["Municipio"].unique()
+        n_cities = min(len(remaining), rng.integers(0, 3))
+        cities = list(rng.choice(remaining, n_cities, replace=False))
+        start = int(rng.choice([703, 758, 1710, 1920, 2500, 3300]))
+        bandwidth = int(rng.choice([5, 10, 20, 40]))
+        rows.append(
+            {
+                "AnoBase": year,
+                "Entidade": str(rng.choice(["CLARO", "TIM", "VIVO"])),
+                "NumTermo": str(i),
+                "AnoTermo": int(rng.integers(2005, 2025)),
+                "UF": state,
+                "AreaPrestacao": area,
+                "AreaExclusao": ", ".join(exclusions),
+                "MunicipioExclusao": ", ".join(str(city) for city in cities),
+                "FrequenciaInicial": start,
+                "FrequenciaFinal": start + bandwidth,
+                "FrequenciaCentral": start + bandwidth / 2,
+                "Banda": bandwidth,
+                "Tipo": "ONUS",
+            }
+        )
+    return pd.DataFrame(rows).astype("string")
+
+
+def make_scenario_terms(
+    data_processor,
+    entities,
+    terms_per_uf,
+    area_type,
+    exclusions,
+    states=SCENARIO_STATES,
+    year=2023,
+    seed=0,
+):
+    """
+    Build a synthetic portfolio with a controlled shape
+
+    Args:
+        data_processor: DataProcessor with the reference data
+        entities: Number of operators, taken from OPERADORAS
+        terms_per_uf: Terms of each operator in each state
+        area_type: "toda_uf" for whole-state terms, or "setores" for the
+            smallest third of each state's other service areas
+        exclusions: Largest number of exclusion areas and of excluded
+            municipalities of each term
+        states: States of the portfolio
+        year: Population base year
+        seed: Seed for the random generator
+
+    Returns:
+        DataFrame: Terms with string columns, as in make_terms
+    """
+    if area_type not in AREA_TYPES:
+        raise ValueError(f"Tipo de área inválido: {area_type}")
+    rng = np.random.default_rng(seed)
+    area_sizes = data_processor.df_area.groupby(
+        ["UF", "AreaPrestacao"], observed=True
+    ).size()
+
+    rows = []
+    for state in states:
+        if area_type == "toda_uf":
+            areas = ["Toda UF"]
+        else:
+            sizes = area_sizes.loc[state].drop("Toda UF", errors="ignore")
+            areas = list(sizes.sort_values().index[: max(len(sizes) // 3, 1)])
+
+        for entity in OPERADORAS[:entities]:
+            for _ in range(terms_per_uf):
+                area = str(rng.choice(areas))
+                exclusion_options = data_processor.get_exclusion_areas(
+                    year, state, area
+                )
+                n_areas = min(len(exclusion_options), exclusions)
+                excluded_areas = list(
+                    rng.choice(exclusion_options, n_areas, replace=False)
+                )
+                remaining = data_processor.exclude_areas_from_df(
+                    area, year, state, ", ".join(excluded_areas)
+                )["Municipio"].unique()
+                n_cities = min(len(remaining) - 1, exclusions)
+                cities = list(rng.choice(remaining, max(n_cities, 0), replace=False))
+                start = int(rng.choice([703, 758, 1710, 1920, 2500, 3300]))
+                bandwidth = int(rng.choice([5, 10, 20, 40]))
+                rows.append(
+                    {
+                        "AnoBase": year,
+                        "Entidade": entity,
+                        "NumTermo": str(len(rows)),
+                        "AnoTermo": int(rng.integers(2005, 2025)),
+                        "UF": state,
+                        "AreaPrestacao": area,
+                        "AreaExclusao": ", ".join(excluded_areas),
+                        "MunicipioExclusao": ", ".join(str(city) for city in cities),
+                        "FrequenciaInicial": start,
+                        "FrequenciaFinal": start + bandwidth,
+                        "FrequenciaCentral": start + bandwidth / 2,
+                        "Banda": bandwidth,
+                        "Tipo": "ONUS",
+                    }
+                )
+    return pd.DataFrame(rows).astype("string")
+
+
+def _peak_memory(func):
+    """Peak memory traced while calling func, in MB"""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2**20
+
+
+def bench_pipeline(
+    data_processor, scenarios=SCENARIOS, repeat=3, max_terms_onus=20, seed=0
+):
+    """
+    Time each stage of the pipeline on synthetic portfolios
+
+    Stages are timed without tracing (best of `repeat`) and then run once more
+    under tracemalloc for their peak memory. calculate_onus runs with a new
+    calculator, so its factor cache is cold, for up to max_terms_onus terms.
+
+    Args:
+        data_processor: DataProcessor with the reference data
+        scenarios: Dicts with the entidades, termos_por_uf, areas and exclusoes
+            of make_scenario_terms
+        repeat: Number of timed runs of each stage
+        max_terms_onus: Terms calculated one by one with calculate_onus
+        seed: Seed of the portfolios
+
+    Returns:
+        list: One dict per scenario and stage, with the scenario parameters,
+            the size of the stage input and output, ms and peak MB
+    """
+    results = []
+    for scenario in scenarios:
+        df_terms = make_scenario_terms(
+            data_processor,
+            scenario["entidades"],
+            scenario["termos_por_uf"],
+            scenario["areas"],
+            scenario["exclusoes"],
+            seed=seed,
+        )
+        df_data = data_processor.gerar_tabela_final(df_terms)
+        df_keys = df_data[TERM_KEYS].drop_duplicates().head(max_terms_onus)
+        rol = {key: 1e6 for key in zip(df_terms["Entidade"], df_terms["UF"])}
+
+        def exclusion_areas():
+            for term in df_terms.itertuples(index=False):
+                data_processor.get_exclusion_areas(
+                    term.AnoBase, term.UF, term.AreaPrestacao
+                )
+
+        def onus_by_term():
+            calculator = OnusCalculator(data_processor)
+            for key in df_keys.itertuples(index=False):
+                calculator.calculate_onus(*key, 1e6, df_data)
+
+        stages = {
+            "get_exclusion_areas": (exclusion_areas, len(df_terms)),
+            "gerar_tabela_final": (
+                lambda: data_processor.gerar_tabela_final(df_terms),
+                len(df_terms),
+            ),
+            "calculate_onus": (onus_by_term, len(df_keys)),
+            "calculate_all_onus": (
+                lambda: OnusCalculator(data_processor).calculate_all_onus(
+                    df_data, rol
+                ),
+                len(df_data),
+            ),
+        }
+        for stage, (func, n_inputs) in stages.items():
+            results.append(
+                {
+                    **scenario,
+                    "etapa": stage,
+                    "termos": len(df_terms),
+                    "linhas": len(df_data),
+                    "entradas": n_inputs,
+                    "ms": _best_of(func, repeat) * 1e3,
+                    "pico_mb": _peak_memory(func),
+                }
+            )
+    return results
+
+
+def save_results(results, path, data_processor):
+    """
+    Save benchmark results as JSON, with the environment they were measured in
+
+    Args:
+        results: List of dicts, e.g. from bench_pipeline
+        path: Path of the JSON file
+        data_processor: DataProcessor whose reference data was used
+    """
+    environment = {
+        "data": dt.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "dados": data_processor.data_fingerprint,
+    }
+    Path(path).write_text(
+        json.dumps({"ambiente": environment, "resultados": results}, indent=2)
+    )
+
+
+def compare_results(baseline_path, results):
+    """
+    Compare results of bench_pipeline with a run saved by save_results
+
+    Args:
+        baseline_path: JSON file of the baseline run
+        results: Results of the new run
+
+    Returns:
+        DataFrame: ms and pico_mb of both runs per scenario and stage, with
+            the ratio of the new run to the baseline
+    """
+    # Runs with other portfolio sizes are not comparable
+    keys = [*SCENARIOS[0], "etapa", "termos", "entradas"]
+    df_baseline = pd.DataFrame(
+        json.loads(Path(baseline_path).read_text())["resultados"]
+    )
+    df_new = pd.DataFrame(results)
+    df = df_baseline[keys + ["ms", "pico_mb"]].merge(
+        df_new[keys + ["ms", "pico_mb"]], on=keys, suffixes=("_base", "")
+    )
+    df["razao_ms"] = df["ms"] / df["ms_base"]
+    df["razao_mb"] = df["pico_mb"] / df["pico_mb_base"]
+    return df
+
+
+def _best_of(func, repeat):
+    """Best wall-clock time of `repeat` calls to func, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_municipality_factors(
+    municipalities=(10, 100, 853), terms=(1, 10, 50), repeat=3
+):
+    """
+    Time the loop and the vectorized municipality factor engines
+
+    Returns:
+        DataFrame: One row per (municipalities, terms) with timings in ms
+    """
+    calculator = OnusCalculator(data_processor=None)
+    results = []
+    for n_mun in municipalities:
+        for n_terms in terms:
+            df_term, df_other_terms, pop_total = make_factor_inputs(n_mun, n_terms)
+            args = (df_term, df_other_terms, pop_total, 1_000_000.0)
+            loop = _best_of(lambda: _loop_municipality_factors(*args), repeat)
+            vectorized = _best_of(
+                lambda: calculator._calculate_municipality_factors(*args), repeat
+            )
+            results.append(
+                {
+                    "municipios": n_mun,
+                    "termos": n_terms,
+                    "loop_ms": loop * 1e3,
+                    "vetorizado_ms": vectorized * 1e3,
+                    "speedup": loop / vectorized,
+                }
+            )
+    return pd.DataFrame(results)
+
+
+def bench_load_data(repeat=3):
+    """
+    Compare the all-string reference tables with the typed representations,
+    parsed from the CSVs or loaded from the Feather cache
+
+    Returns:
+        DataFrame: Load time, memory and (AnoBase, UF) filter time per layout
+    """
+
+    def load_strings():
+        return (
+            pd.read_csv(AREA_PREST, dtype="string"),
+            pd.read_csv(BASE_POP, dtype="string"),
+        )
+
+    def load_typed(dtype_backend, use_cache=False):
+        processor = DataProcessor(dtype_backend=dtype_backend, use_cache=use_cache)
+        return processor.df_area, processor.df_pop
+
+    layouts = {
+        "string": (load_strings, "2023"),
+        "numpy_nullable": (lambda: load_typed("numpy_nullable"), 2023),
+        "pyarrow": (lambda: load_typed("pyarrow"), 2023),
+        "numpy_nullable+cache": (lambda: load_typed("numpy_nullable", True), 2023),
+        "pyarrow+cache": (lambda: load_typed("pyarrow", True), 2023),
+    }
+    results = []
+    for name, (load, year) in layouts.items():
+        load_time = _best_of(load, repeat)
+        df_area, df_pop = load()
+
+        def filter_year_state():
+            df_year = df_pop[df_pop["AnoBase"] == year]
+            return df_year[df_year["UF"] == "MG"]
+
+        results.append(
+            {
+                "layout": name,
+                "carga_ms": load_time * 1e3,
+                "memoria_mb": (
+                    df_area.memory_usage(deep=True).sum()
+                    + df_pop.memory_usage(deep=True).sum()
+                )
+                / 2**20,
+                "filtro_ms": _best_of(filter_year_state, repeat * 10) * 1e3,
+            }
+        )
+    return pd.DataFrame(results)
+
+
+def bench_gerar_tabela_final(sizes=(10, 100, 1000, 10000), loop_max_terms=1000):
+    """
+    Time the per-term loop and the set-based gerar_tabela_final
+
+    The loop takes tens of milliseconds per term, so it is skipped above
+    loop_max_terms.
+
+    Returns:
+        DataFrame: One row per portfolio size with timings in ms
+    """
+    data_processor = DataProcessor().warm_up()
+    results = []
+    for n_terms in sizes:
+        df_terms = make_terms(data_processor, n_terms)
+        vectorized = _best_of(lambda: data_processor.gerar_tabela_final(df_terms), 1)
+        loop = (
+            _best_of(lambda: _loop_gerar_tabela_final(data_processor, df_terms), 1)
+            if n_terms <= loop_max_terms
+            else np.nan
+        )
+        results.append(
+            {
+                "termos": n_terms,
+                "linhas": len(data_processor.gerar_tabela_final(df_terms)),
+                "loop_ms": loop * 1e3,
+                "vetorizado_ms": vectorized * 1e3,
+                "speedup": loop / vectorized,
+            }
+        )
+    return pd.DataFrame(results)
+
+
+def bench_session_memory(sessions=5):
+    """
+    Measure the memory of one DataProcessor per session against one shared
+    by all sessions, as done by app.get_data_processor
+
+    Returns:
+        dict: Traced memory in MB for both setups and the saving per session
+    """
+
+    def traced(build):
+        tracemalloc.start()
+        objects = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del objects
+        return current / 2**20
+
+    private = traced(lambda: [DataProcessor().warm_up() for _ in range(sessions)])
+    shared = traced(lambda: [DataProcessor().warm_up()] * sessions)
+    return {
+        "sessoes": sessions,
+        "privado_mb": private,
+        "compartilhado_mb": shared,
+        "economia_por_sessao_mb": (private - shared) / max(sessions - 1, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks do cálculo do ônus")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Mede as etapas do pipeline nos cenários sintéticos",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--saida", type=Path, help="JSON com os resultados do pipeline"
+    )
+    parser.add_argument(
+        "--comparar", type=Path, help="JSON de uma execução anterior do pipeline"
+    )
+    args = parser.parse_args()
+
+    if args.pipeline:
+        data_processor = DataProcessor().warm_up()
+        results = bench_pipeline(data_processor, repeat=args.repeat, seed=args.seed)
+        print(pd.DataFrame(results).to_string(index=False))
+        if args.saida:
+            save_results(results, args.saida, data_processor)
+        if args.comparar:
+            print(compare_results(args.comparar, results).to_string(index=False))
+    else:
+        print(bench_municipality_factors(repeat=args.repeat).to_string(index=False))
+        print(bench_load_data(repeat=args.repeat).to_string(index=False))
+        print(bench_session_memory())
+        print(bench_gerar_tabela_final().to_string(index=False))
@@ -1,4 +1,44 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+import threading
+import time
+import numpy as np
 import pandas as pd
+from data_processor import bandwidth_ratio
+from instrumentation import timed
+
+TERM_KEYS = ["AnoBase", "Entidade", "UF", "NumTermo", "AnoTermo"]
+SHARD_KEYS = ["Entidade", "UF"]
+FACTOR_CACHE_SIZE = 64
+
+
+def _mask(condition):
+    """Boolean array of a comparison, with missing values as False"""
+    return condition.to_numpy(dtype=bool, na_value=False)
+
+
+def frame_fingerprint(df):
+    """Hash of the contents of a DataFrame, ignoring its index"""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return sha256(row_hashes.tobytes()).hexdigest()[:16]
+
+
+def _calculate_shard(df_shard, rol_by_entity_uf, pop_totals):
+    """Worker of calculate_all_onus_parallel, timing one (Entidade, UF) shard"""
+    start = time.perf_counter()
+    df_terms, df_factors = OnusCalculator(data_processor=None).calculate_all_onus(
+        df_shard, rol_by_entity_uf, pop_totals
+    )
+    return df_terms, df_factors, time.perf_counter() - start
+
+
+def _check_shard_keys(df_data):
+    """Reject term rows without the Entidade or UF their ROL is looked up by"""
+    missing = df_data[SHARD_KEYS].isna().any(axis=1)
+    if missing.any():
+        terms = ", ".join(df_data.loc[missing, "NumTermo"].astype(str).unique())
+        raise ValueError(f"Termos sem Entidade ou UF: {terms}")
 
 
 class OnusCalculator:
@@ -6,21 +46,38 @@ class OnusCalculator:
     Class responsible for performing ônus calculations based on term data
     """
 
-    def __init__(self, data_processor):
+    def __init__(self, data_processor, cache_size=FACTOR_CACHE_SIZE):
         """
         Initialize the calculator with a data processor instance
 
         Args:
             data_processor: An instance of DataProcessor to access data
+            cache_size: Number of term factor tables kept by term_factors
         """
         self.data_processor = data_processor
+        self.cache_size = cache_size
+        self._factor_cache = OrderedDict()
+        # The calculator is shared by every Streamlit session
+        self._cache_lock = threading.Lock()
 
+    @timed(rows=lambda result: len(result[1]))
     def calculate_onus(
-        self, year_base, entity, state, term_num, term_year, rol_uf, df_data
+        self,
+        year_base,
+        entity,
+        state,
+        term_num,
+        term_year,
+        rol_uf,
+        df_data,
+        fingerprint=None,
     ):
         """
         Calculate the ônus for a specific term
 
+        The factors do not depend on the ROL, so they come from term_factors and
+        a new ROL only scales them.
+
         Args:
             year_base: Base year for population data
             entity: Entity (operator) name
@@ -29,134 +86,497 @@ class OnusCalculator:
             term_year: Term year
             rol_uf: Revenue (ROL) for the state
             df_data: DataFrame with term data
+            fingerprint: Identifies the contents of df_data, see term_factors
 
         Returns:
             tuple: (total_onus, factors_dataframe, total_population)
         """
-        # Ensure data is clean
-        df_data = df_data.copy()
-        df_data.drop_duplicates(inplace=True)
+        df_factors, pop_total = self.term_factors(
+            year_base, entity, state, term_num, term_year, df_data, fingerprint
+        )
+        # As float64, so a municipality without population data leaves the
+        # total as NaN rather than pd.NA
+        mun_onus = (
+            df_factors["fatorFreq"].astype("float64")
+            * df_factors["fatorPop"].astype("float64")
+            * 0.02
+            * rol_uf
+        )
+        return (
+            float(mun_onus.sum(skipna=False)),
+            df_factors.assign(onusMunicipio=mun_onus),
+            pop_total,
+        )
+
+    def term_factors(
+        self, year_base, entity, state, term_num, term_year, df_data, fingerprint=None
+    ):
+        """
+        Frequency and population factors of each municipality of a term, kept
+        in an LRU cache of cache_size entries
+
+        Args:
+            year_base: Base year for population data
+            entity: Entity (operator) name
+            state: State code (UF)
+            term_num: Term number
+            term_year: Term year
+            df_data: DataFrame with term data
+            fingerprint: Any hashable value that changes whenever df_data
+                does, e.g. TermStore.fingerprint. Defaults to a hash of df_data
+
+        Returns:
+            tuple: (factors_dataframe with Municipio, codMun, fatorFreq and
+                fatorPop, total_population). The frame must not be modified
+        """
+        df_factors, pop_total, _ = self._term_entry(
+            year_base, entity, state, term_num, term_year, df_data, fingerprint
+        )
+        return df_factors, pop_total
+
+    def sweep_onus(
+        self,
+        year_base,
+        entity,
+        state,
+        term_num,
+        term_year,
+        rol_values,
+        df_data,
+        bandwidths=None,
+        central_frequencies=None,
+        fingerprint=None,
+    ):
+        """
+        ônus of a term for every pair of a spectrum setting and a ROL value
+
+        A setting replaces the term's BW/Freq ratio in all its municipalities,
+        while the other terms' ratios and the population factors stay as
+        cached by term_factors, so the whole grid is a couple of array products.
 
-        # Filter data for the base year
-        df_year_base = df_data[df_data["AnoBase"] == year_base]
+        Args:
+            year_base: Base year for population data
+            entity: Entity (operator) name
+            state: State code (UF)
+            term_num: Term number
+            term_year: Term year
+            rol_values: Sequence of ROL values
+            df_data: DataFrame with term data
+            bandwidths: Banda of each setting. Defaults to the term's current
+                allocation as the only setting
+            central_frequencies: FrequenciaCentral of each setting, same length
+                as bandwidths. Given if and only if bandwidths is
+            fingerprint: Identifies the contents of df_data, see term_factors
+
+        Returns:
+            DataFrame: ônus with one row per setting (Banda, FrequenciaCentral)
+                and one column per ROL value
+        """
+        df_factors, _, other_sums = self._term_entry(
+            year_base, entity, state, term_num, term_year, df_data, fingerprint
+        )
+        rol_values = np.asarray(rol_values, dtype=float)
+        # Municipalities without population leave the ônus undefined (NaN), as
+        # in calculate_onus
+        factor_pop = df_factors["fatorPop"].to_numpy(dtype=float, na_value=np.nan)
+
+        if (bandwidths is None) != (central_frequencies is None):
+            raise ValueError("Informe bandwidths e central_frequencies juntos")
+        if bandwidths is None:
+            factor_freq = df_factors["fatorFreq"].to_numpy(
+                dtype=float, na_value=np.nan
+            )[None, :]
+            index = pd.Index(["atual"], name="cenario")
+        else:
+            bandwidths = np.asarray(bandwidths, dtype=float)
+            central_frequencies = np.asarray(central_frequencies, dtype=float)
+            if bandwidths.shape != central_frequencies.shape:
+                raise ValueError(
+                    "bandwidths e central_frequencies devem ter o mesmo tamanho"
+                )
+            ratios = (bandwidths / central_frequencies)[:, None]
+            freq_denominator = ratios + other_sums[None, :]
+            factor_freq = np.divide(
+                ratios,
+                freq_denominator,
+                out=np.zeros_like(freq_denominator),
+                where=freq_denominator > 0,
+            )
+            index = pd.MultiIndex.from_arrays(
+                [bandwidths, central_frequencies], names=["Banda", "FrequenciaCentral"]
+            )
+
+        unit_onus = 0.02 * (factor_freq @ factor_pop)
+        return pd.DataFrame(
+            np.outer(unit_onus, rol_values),
+            index=index,
+            columns=pd.Index(rol_values, name="ROL"),
+        )
+
+    def _term_entry(
+        self, year_base, entity, state, term_num, term_year, df_data, fingerprint
+    ):
+        """
+        Cached (factors, population, somaOutros array) of a term, computing
+        them on a miss
+        """
+        if fingerprint is None:
+            fingerprint = frame_fingerprint(df_data)
+        key = (year_base, entity, state, term_num, term_year, fingerprint)
+        with self._cache_lock:
+            if key in self._factor_cache:
+                self._factor_cache.move_to_end(key)
+                return self._factor_cache[key]
+
+        # Computed outside the lock, so a miss does not block other sessions
+        entry = self._calculate_term_factors(
+            year_base, entity, state, term_num, term_year, df_data
+        )
+        with self._cache_lock:
+            self._factor_cache[key] = entry
+            self._factor_cache.move_to_end(key)
+            while len(self._factor_cache) > self.cache_size:
+                self._factor_cache.popitem(last=False)
+        return entry
+
+    def clear_cache(self):
+        """Drop every cached factor table"""
+        with self._cache_lock:
+            self._factor_cache.clear()
+
+    def _calculate_term_factors(
+        self, year_base, entity, state, term_num, term_year, df_data
+    ):
+        """Uncached term_factors"""
+        # The base year is one boolean mask over df_data, and the rows of the
+        # term and of the other terms are narrowed down from it as positions,
+        # comparing each further column only on the rows left. Only the
+        # selected rows of the columns used are taken, so no intermediate
+        # frame is built. Duplicated rows do not change the distinct sums and
+        # pairs below, so they are not dropped
+        is_year = _mask(df_data["AnoBase"] == year_base)
 
         # Calculate total population for the service area
         pop_total = (
-            df_year_base[["Municipio", "popMun"]].drop_duplicates()["popMun"].sum()
+            df_data.loc[is_year, ["Municipio", "popMun"]]
+            .drop_duplicates()["popMun"]
+            .sum()
         )
 
-        # Count frequencies and prepare data
-        df_count_freq = self._count_frequencies(df_year_base)
-        df_data_count_freq = df_year_base.merge(
-            df_count_freq, how="inner", on="FrequenciaCentral"
+        # Rows of the entity and state with a central frequency
+        rows = np.flatnonzero(is_year & _mask(df_data["UF"] == state))
+        rows = rows[_mask(df_data["Entidade"].iloc[rows] == entity)]
+        rows = rows[_mask(df_data["FrequenciaCentral"].iloc[rows].notna())]
+
+        term_nums = df_data["NumTermo"].iloc[rows]
+        term_rows = rows[
+            _mask(term_nums == term_num)
+            & _mask(df_data["AnoTermo"].iloc[rows] == term_year)
+        ]
+        other_rows = rows[_mask(term_nums != term_num)]
+
+        # Frames not expanded by gerar_tabela_final lack the ratio column
+        if "BW_Freq" in df_data:
+            ratios = df_data["BW_Freq"].to_numpy(dtype=float, na_value=np.nan)
+        else:
+            ratios = bandwidth_ratio(df_data)
+
+        df_term = pd.DataFrame(
+            {
+                col: df_data[col].array[term_rows]
+                for col in ["Municipio", "codMun", "popMun"]
+            }
+        ).assign(BW_Freq=ratios[term_rows])
+        df_other_terms = pd.DataFrame(
+            {
+                "codMun": df_data["codMun"].array[other_rows],
+                "BW_Freq": ratios[other_rows],
+            }
         )
 
-        # Get term data
-        df_term = self._get_term_data(
-            df_data_count_freq, entity, state, term_num, term_year
-        )
+        # Calculate factors for each municipality, with the ônus of a unit ROL
+        df_sums = self._frequency_sums(df_term, df_other_terms)
+        df_factors, _ = self._factors_from_sums(df_sums, pop_total, 1.0)
+        df_factors = df_factors.drop(columns="onusMunicipio")
 
-        # Get other terms data for comparison
-        df_other_terms = self._get_other_terms_data(
-            df_data_count_freq, entity, state, term_num
+        # Unlike the fatorPop denominator above, which counts every distinct
+        # (Municipio, popMun) of the base year, the reported population only
+        # counts the term's own municipalities, once per codMun
+        pop_total = self.data_processor.get_municipalities_population(
+            year_base, df_factors["codMun"]
         )
 
-        # Calculate factors and ônus for each municipality
-        df_factors, total_onus = self._calculate_municipality_factors(
-            df_term, df_other_terms, pop_total, rol_uf
+        return df_factors, pop_total, df_sums["somaOutros"].to_numpy(dtype=float)
+
+    @timed(rows=lambda result: len(result[1]))
+    def calculate_all_onus(self, df_data, rol_by_entity_uf, pop_totals=None):
+        """
+        Calculate the ônus for every term in the data at once
+
+        The intermediates shared by the terms (base-year population totals and
+        the distinct BW/Freq ratios per municipality of each entity and state)
+        are computed a single time instead of once per term. Every row must
+        have its Entidade and UF.
+
+        Args:
+            df_data: DataFrame with term data for all terms
+            rol_by_entity_uf: Mapping of (entity, state) to the ROL of the state.
+                Terms whose pair is missing get a NaN ônus
+            pop_totals: Total population of each base year, from
+                population_totals. Defaults to the totals of df_data, and must
+                be given when df_data is only part of the terms
+
+        Returns:
+            tuple: (terms_dataframe, factors_dataframe), both keyed by
+                AnoBase, Entidade, UF, NumTermo and AnoTermo
+        """
+        _check_shard_keys(df_data)
+
+        # Total population of each base year, over every term row as in
+        # term_factors, including those without a central frequency
+        if pop_totals is None:
+            pop_totals = self.population_totals(df_data)
+
+        df_data = self._prepare_all_terms(df_data)
+        mun_keys = TERM_KEYS + ["codMun"]
+        area_keys = ["AnoBase", "Entidade", "UF", "codMun"]
+
+        # Municipalities of each term, in the order they appear in the data
+        df_factors = (
+            df_data.groupby(mun_keys, sort=False, observed=True)
+            .agg(Municipio=("Municipio", "first"), popMun=("popMun", "first"))
+            .reset_index()
+        )
+        term_sums = (
+            df_data[mun_keys + ["BW_Freq"]]
+            .drop_duplicates()
+            .groupby(mun_keys, sort=False, observed=True)["BW_Freq"]
+            .sum()
+            .rename("somaTermo")
         )
 
-        subconjunto_mun = df_factors["codMun"].astype("string").unique()
+        # Distinct ratios per municipality and the term numbers using each one.
+        # A ratio counts for the other terms of a term unless that term's
+        # number is the only one using it
+        df_ratios = (
+            df_data[area_keys + ["BW_Freq", "NumTermo"]]
+            .drop_duplicates()
+            .groupby(area_keys + ["BW_Freq"], sort=False, observed=True)[
+                "NumTermo"
+            ]
+            .agg(numTermos="nunique", NumTermo="first")
+            .reset_index()
+        )
+        all_sums = (
+            df_ratios.groupby(area_keys, sort=False, observed=True)["BW_Freq"]
+            .sum()
+            .rename("somaTodos")
+        )
+        exclusive_sums = (
+            df_ratios[df_ratios["numTermos"] == 1]
+            .groupby(area_keys + ["NumTermo"], sort=False, observed=True)[
+                "BW_Freq"
+            ]
+            .sum()
+            .rename("somaExclusiva")
+        )
 
-        pop_total = df_year_base.loc[df_year_base["codMun"].astype("string").isin(subconjunto_mun), ["codMun", "popMun"]].drop_duplicates()["popMun"].sum()
+        df_rol = pd.DataFrame(
+            [(entity, state, rol) for (entity, state), rol in rol_by_entity_uf.items()],
+            columns=["Entidade", "UF", "ROL"],
+        ).astype({"ROL": "float"})
+
+        df_factors = (
+            df_factors.join(term_sums, on=mun_keys)
+            .join(all_sums, on=area_keys)
+            .join(exclusive_sums, on=area_keys + ["NumTermo"])
+            .join(pop_totals, on="AnoBase")
+            .merge(df_rol, how="left", on=["Entidade", "UF"])
+        )
+        soma_outros = df_factors["somaTodos"] - df_factors["somaExclusiva"].fillna(0.0)
 
+        # Same factors as _calculate_municipality_factors
+        df_factors["fatorPop"] = df_factors["popMun"] / df_factors["popBase"]
+        freq_denominator = df_factors["somaTermo"] + soma_outros
+        df_factors["fatorFreq"] = (df_factors["somaTermo"] / freq_denominator).where(
+            freq_denominator > 0, 0
+        )
+        df_factors["onusMunicipio"] = (
+            df_factors["fatorFreq"] * df_factors["fatorPop"] * 0.02 * df_factors["ROL"]
+        )
 
-        return total_onus, df_factors, pop_total
+        df_terms = (
+            df_factors.groupby(TERM_KEYS, sort=False, observed=True)
+            .agg(
+                numMunicipios=("codMun", "size"),
+                popTotal=("popMun", "sum"),
+                comPop=("popMun", "count"),
+                ROL=("ROL", "first"),
+                onusTermo=("onusMunicipio", "sum"),
+                comOnus=("onusMunicipio", "count"),
+            )
+            .reset_index()
+        )
+        # Undefined, like in calculate_onus, if any municipality has no ônus
+        # (no ROL or no population data)
+        df_terms["onusTermo"] = df_terms["onusTermo"].where(
+            df_terms.pop("comOnus") == df_terms["numMunicipios"]
+        )
+        # The population is only undefined if none of them has data, as in
+        # DataProcessor.get_municipalities_population
+        df_terms["popTotal"] = df_terms["popTotal"].where(df_terms.pop("comPop") > 0)
+        df_factors = df_factors[
+            TERM_KEYS
+            + ["Municipio", "codMun", "fatorFreq", "fatorPop", "onusMunicipio"]
+        ]
 
-    def _count_frequencies(self, df):
-        """Count frequency occurrences in the dataframe"""
-        return pd.DataFrame(df.FrequenciaCentral.value_counts())
+        return df_terms, df_factors
 
-    def _get_term_data(self, df, entity, state, term_num, term_year):
-        """Filter dataframe to get data for the specific term"""
-        # Filter by entity, state, term number and year
-        df_entity = df[df["Entidade"] == entity]
-        df_state = df_entity[df_entity["UF"] == state]
-        df_term_num = df_state[df_state["NumTermo"] == term_num]
-        df_term = df_term_num[df_term_num["AnoTermo"] == term_year]
+    def calculate_all_onus_parallel(self, df_data, rol_by_entity_uf, max_workers=None):
+        """
+        Same as calculate_all_onus, with the (Entidade, UF) shards of the data
+        calculated in a pool of processes
 
-        # Calculate bandwidth/frequency ratio
-        df_term.loc[:, "BW_Freq"] = df_term["Banda"].astype("float") / df_term[
-            "FrequenciaCentral"
-        ].astype("float")
+        The other terms of a term are always in its entity and state, so the
+        shards are independent once the population totals of the base years,
+        which span every shard, are computed upfront and sent to each worker.
 
-        return df_term
+        Args:
+            df_data: DataFrame with term data for all terms
+            rol_by_entity_uf: Mapping of (entity, state) to the ROL of the state
+            max_workers: Number of processes, defaults to the number of CPUs
 
-    def _get_other_terms_data(self, df, entity, state, term_num):
-        """Filter dataframe to get data for other terms from the same entity and state"""
-        # Filter by entity and state, excluding the specific term
-        df_entity = df[df["Entidade"] == entity]
-        df_state = df_entity[df_entity["UF"] == state]
-        df_other_terms = df_state[df_state["NumTermo"] != term_num]
+        Returns:
+            tuple: (terms_dataframe, factors_dataframe, timings_dataframe), the
+                last with the rows and seconds of each shard. Results are
+                ordered by shard
+        """
+        # Rows without Entidade or UF would silently fall out of the shards
+        _check_shard_keys(df_data)
+        pop_totals = self.population_totals(df_data)
+        shards = [
+            (key, df_shard)
+            for key, df_shard in df_data.groupby(SHARD_KEYS, sort=False, observed=True)
+        ]
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _calculate_shard,
+                    df_shard,
+                    {key: rol_by_entity_uf[key]} if key in rol_by_entity_uf else {},
+                    pop_totals,
+                )
+                for key, df_shard in shards
+            ]
+            results = [future.result() for future in futures]
+
+        df_timings = pd.DataFrame(
+            [
+                (entity, state, len(df_shard), seconds)
+                for ((entity, state), df_shard), (_, _, seconds) in zip(shards, results)
+            ],
+            columns=SHARD_KEYS + ["numLinhas", "segundos"],
+        )
+        if not results:
+            return *self.calculate_all_onus(df_data, rol_by_entity_uf), df_timings
 
-        # Calculate bandwidth/frequency ratio
-        df_other_terms["BW_Freq"] = (
-            df_other_terms["Banda"].astype('float') / df_other_terms["FrequenciaCentral"].astype('float')
+        df_terms = pd.concat([terms for terms, _, _ in results], ignore_index=True)
+        df_factors = pd.concat(
+            [factors for _, factors, _ in results], ignore_index=True
         )
+        return df_terms, df_factors, df_timings
+
+    def _prepare_all_terms(self, df_data):
+        """Distinct term rows with a central frequency and their BW/Freq ratio"""
+        df_data = df_data.drop_duplicates()
+        df_data = df_data[df_data["FrequenciaCentral"].notna()]
+        if "BW_Freq" in df_data:
+            return df_data
+        return df_data.assign(BW_Freq=bandwidth_ratio(df_data))
+
+    def population_totals(self, df_data):
+        """
+        Total population of each base year, counting each municipality once
 
-        return df_other_terms
+        Returns:
+            Series: popBase indexed by AnoBase
+        """
+        return (
+            df_data[["AnoBase", "Municipio", "popMun"]]
+            .drop_duplicates()
+            .groupby("AnoBase", sort=False, observed=True)["popMun"]
+            .sum()
+            .rename("popBase")
+        )
 
     def _calculate_municipality_factors(
         self, df_term, df_other_terms, pop_total, rol_uf
     ):
         """Calculate factors and ônus for each municipality"""
-        # Get list of municipalities in the term
-        mun_codes = list(df_term["codMun"].unique())
-
-        # Initialize results
-        df_factors = pd.DataFrame()
-        total_onus = 0
-
-        # Calculate for each municipality
-        for mun_code in mun_codes:
-            # Population factor
-            pop_mun = df_term[df_term["codMun"] == mun_code]["popMun"].unique()
-            factor_pop = pop_mun / pop_total
-
-            # Frequency factor
-            freq_numerator = (
-                df_term[df_term["codMun"] == mun_code]["BW_Freq"].unique().sum()
-            )
-            freq_denominator = freq_numerator
+        return self._factors_from_sums(
+            self._frequency_sums(df_term, df_other_terms), pop_total, rol_uf
+        )
 
-            # Add other terms' frequencies if they exist for this municipality
-            other_terms_mun = df_other_terms[df_other_terms["codMun"] == mun_code]
-            if not other_terms_mun.empty:
-                freq_denominator += other_terms_mun["BW_Freq"].unique().sum()
+    def _factors_from_sums(self, df_sums, pop_total, rol_uf):
+        """Factors and ônus for each municipality from its BW/Freq sums"""
 
-            # Calculate frequency factor
-            factor_freq = (
-                freq_numerator / freq_denominator if freq_denominator > 0 else 0
-            )
+        # Population factor
+        factor_pop = df_sums["popMun"] / pop_total
 
-            # Calculate ônus for this municipality
-            mun_onus = factor_freq * factor_pop * 0.02 * rol_uf
-            total_onus += mun_onus[0] if isinstance(mun_onus, pd.Series) else mun_onus
-
-            # Add to factors dataframe
-            mun_name = df_term[df_term["codMun"] == mun_code]["Municipio"].unique()
-            df_factor_row = pd.DataFrame(
-                {
-                    "Municipio": mun_name,
-                    "codMun": mun_code,
-                    "fatorFreq": factor_freq,
-                    "fatorPop": factor_pop,
-                    "onusMunicipio": mun_onus,
-                }
-            )
-            df_factors = pd.concat([df_factors, df_factor_row])
+        # Frequency factor, zero where there is no spectrum at all
+        freq_numerator = df_sums["somaTermo"]
+        freq_denominator = freq_numerator + df_sums["somaOutros"]
+        factor_freq = (freq_numerator / freq_denominator).where(
+            freq_denominator > 0, 0
+        )
+
+        # Calculate ônus for each municipality
+        mun_onus = factor_freq * factor_pop * 0.02 * rol_uf
+
+        df_factors = pd.DataFrame(
+            {
+                "Municipio": df_sums["Municipio"],
+                "codMun": df_sums["codMun"],
+                "fatorFreq": factor_freq,
+                "fatorPop": factor_pop,
+                "onusMunicipio": mun_onus,
+            }
+        )
+
+        return df_factors, mun_onus.sum(skipna=False)
+
+    def _frequency_sums(self, df_term, df_other_terms):
+        """
+        Sum the distinct BW/Freq ratios per municipality of the term and of the
+        other terms, keeping the municipalities in the order they appear in the term
+
+        Returns:
+            DataFrame: Municipio, codMun, popMun, somaTermo and somaOutros
+        """
+        df_sums = df_term.drop_duplicates("codMun")[
+            ["Municipio", "codMun", "popMun"]
+        ].reset_index(drop=True)
+
+        term_sums = (
+            df_term[["codMun", "BW_Freq"]]
+            .drop_duplicates()
+            .groupby("codMun", sort=False, observed=True)["BW_Freq"]
+            .sum()
+        )
+        other_sums = (
+            df_other_terms[["codMun", "BW_Freq"]]
+            .drop_duplicates()
+            .groupby("codMun", sort=False, observed=True)["BW_Freq"]
+            .sum()
+        )
+
+        df_sums["somaTermo"] = df_sums["codMun"].map(term_sums).astype("float")
+        df_sums["somaOutros"] = (
+            df_sums["codMun"].map(other_sums).astype("float").fillna(0.0)
+        )
 
-        return df_factors, total_onus
+        return df_sums
 
     def validate_calculation_inputs(
         self, year_base, entity, state, term_num, term_year, rol_uf
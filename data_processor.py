@@ -1,10 +1,50 @@
-from functools import cached_property
+from functools import cached_property, wraps
+from hashlib import sha256
 from pathlib import Path
+import os
+import tempfile
+import threading
+import warnings
+import numpy as np
 import pandas as pd
+from instrumentation import timed
 
 ROOT = Path(__file__).parent
 AREA_PREST = ROOT / "data/df_Mun_UF_Area.csv"
 BASE_POP = ROOT / "data/pop_2014_2024.csv"
+CACHE_DIR = ROOT / "data/.cache"
+AREA_DTYPES = {"UF": "category", "codMun": "Int32", "AreaPrestacao": "category"}
+POP_DTYPES = {
+    "UF": "category",
+    "Municipio": "category",
+    "popMun": "Int32",
+    "AnoBase": "Int16",
+    "codMun": "Int32",
+    "popUF": "Int64",
+}
+AREA_KEY_COLUMNS = [
+    "AnoBase",
+    "UF",
+    "AreaPrestacao",
+    "AreaExclusao",
+    "MunicipioExclusao",
+]
+EXPECTED_COLUMNS = [
+    "AnoBase",
+    "Entidade",
+    "NumTermo",
+    "AnoTermo",
+    "UF",
+    "AreaPrestacao",
+    "AreaExclusao",
+    "MunicipioExclusao",
+    "FrequenciaInicial",
+    "FrequenciaFinal",
+    "FrequenciaCentral",
+    "Banda",
+    "Tipo",
+]
+TERM_CHUNK_ROWS = 5_000
 OPERADORAS = [
     "ALGAR",
     "BRISANET",
@@ -27,19 +67,219 @@ OPERADORAS = [
 ]
 
 
-class DataProcessor:
+def locked_cached_property(func):
+    """
+    Like functools.cached_property, but computed at most once even when several
+    threads (Streamlit sessions) read it at the same time. The instance must
+    have a `_lock` attribute.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def getter(self):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self.__dict__:
+                self.__dict__[name] = func(self)
+            return self.__dict__[name]
+
+    return property(getter)
+
+
+def _frame_nbytes(df):
+    """Bytes of a frame, counting categorical columns by their codes only"""
+    return sum(
+        (
+            col.cat.codes.nbytes
+            if isinstance(col.dtype, pd.CategoricalDtype)
+            else col.memory_usage(index=False, deep=True)
+        )
+        for _, col in df.items()
+    )
+
+
+def _expand_ranges(starts, stops):
+    """Concatenate the integer ranges [start, stop) into one array of positions"""
+    lengths = stops - starts
+    ends = np.cumsum(lengths)
+    total = ends[-1] if len(ends) else 0
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(total)
+
+
+def missing_term_columns(source):
+    """
+    Expected columns missing from a terms CSV, reading only its header
+
+    Args:
+        source: Path or file-like object, rewound after reading the header
+
+    Returns:
+        list: Missing columns, in the order of EXPECTED_COLUMNS
+    """
+    header = pd.read_csv(source, dtype="string", nrows=0).columns
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return [col for col in EXPECTED_COLUMNS if col not in header]
+
+
+def iter_term_chunks(source, chunksize=TERM_CHUNK_ROWS):
+    """
+    Read a terms CSV in chunks, so memory is bounded by the chunk size
+
+    Yields:
+        DataFrame: Up to chunksize rows of the EXPECTED_COLUMNS as strings,
+            with missing values as empty strings
+    """
+    with pd.read_csv(
+        source, dtype="string", usecols=EXPECTED_COLUMNS, chunksize=chunksize
+    ) as reader:
+        for df_chunk in reader:
+            yield df_chunk.loc[:, EXPECTED_COLUMNS].fillna("")
+
+
+def bandwidth_ratio(df):
+    """
+    Banda / FrequenciaCentral of each row as floats, NaN where either is not a
+    number
+
+    Returns:
+        ndarray: One ratio per row of df
+    """
+    return (
+        pd.to_numeric(df["Banda"], errors="coerce")
+        / pd.to_numeric(df["FrequenciaCentral"], errors="coerce")
+    ).to_numpy(dtype=float, na_value=np.nan)
+
+
+def term_row_hashes(df):
+    """64-bit hash of each term row over the EXPECTED_COLUMNS, as strings"""
+    return pd.util.hash_pandas_object(
+        df.loc[:, EXPECTED_COLUMNS].astype("string"), index=False
+    ).to_numpy()
+
+
+class AreaExpansionCache:
+    """
+    Expansions already computed by DataProcessor.gerar_tabela_final for one
+    session's term table, so a rerun only expands the terms that changed.
+
+    Rows are kept per AREA_KEY_COLUMNS combination, and the last result is kept
+    with the hashes of the term rows it was built from and the range of rows
+    of each term in it.
+    """
+
     def __init__(self):
-        """Initialize the DataProcessor class"""
+        """Initialize an empty cache"""
+        self.positions = {}
+        self.row_hashes = None
+        self.result = None
+        self.term_ranges = {}
+
+
+class DataProcessor:
+    """
+    Reference area and population data with the indexes derived from it.
+
+    An instance is read-only once loaded, so a single one can be shared by all
+    sessions of the process: lazily built indexes are guarded by a lock and the
+    frames returned by the lookups must not be modified in place.
+    """
+
+    def __init__(self, dtype_backend="numpy_nullable", use_cache=True):
+        """
+        Initialize the DataProcessor class
+
+        Args:
+            dtype_backend: "numpy_nullable" for pandas nullable integers or
+                "pyarrow" to parse the files with pyarrow and keep the integer
+                columns in Arrow memory
+            use_cache: Load the tables from the Feather cache in CACHE_DIR,
+                rebuilding it whenever the source CSV changes
+        """
+        self.dtype_backend = dtype_backend
+        self.use_cache = use_cache
+        self._lock = threading.RLock()
         self.load_data()
 
+    @timed()
     def load_data(self):
         """Load the necessary data files"""
         try:
-            self.df_area = pd.read_csv(AREA_PREST, dtype="string")
-            self.df_pop = pd.read_csv(BASE_POP, dtype="string")
+            self.df_area = self._read_table(AREA_PREST, AREA_DTYPES)
+            self.df_pop = self._read_table(BASE_POP, POP_DTYPES)
         except Exception as e:
             print(f"Error loading data: {e}")
 
+    def _read_table(self, path, dtypes):
+        """Read a reference table from its binary cache, parsing the CSV if stale"""
+        if not self.use_cache:
+            return self._read_csv(path, dtypes)
+        try:
+            from pyarrow import feather
+        except ImportError:
+            return self._read_csv(path, dtypes)
+
+        cache_path = self._cache_path(path, dtypes)
+        if cache_path.exists():
+            # Converted to the pandas dtypes in use, so the frame is a copy
+            # rather than a view of the file
+            return feather.read_table(cache_path).to_pandas()
+
+        df = self._read_csv(path, dtypes)
+        tmp_path = None
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            for stale in CACHE_DIR.glob(f"{path.stem}-{self.dtype_backend}-*.feather"):
+                stale.unlink(missing_ok=True)
+            # Written under a temporary name unique to this writer, so
+            # concurrent readers never see a partial file and concurrent
+            # writers never write to the same one
+            with tempfile.NamedTemporaryFile(
+                dir=CACHE_DIR, prefix=f"{cache_path.stem}-", suffix=".tmp", delete=False
+            ) as f:
+                tmp_path = Path(f.name)
+                df.to_feather(f, compression="uncompressed")
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            if tmp_path is not None:
+                tmp_path.unlink(missing_ok=True)
+            warnings.warn(
+                f"Error writing cache for {path.name}: {e}",
+                RuntimeWarning,
+                stacklevel=2,
+            )
+        return df
+
+    def _cache_path(self, path, dtypes):
+        """Cache file for a table, keyed by the CSV contents and the dtypes used"""
+        digest = sha256(path.read_bytes())
+        digest.update(repr(sorted(dtypes.items())).encode())
+        key = digest.hexdigest()[:16]
+        return CACHE_DIR / f"{path.stem}-{self.dtype_backend}-{key}.feather"
+
+    def _read_csv(self, path, dtypes):
+        """Read a reference table with integer and categorical columns"""
+        if self.dtype_backend == "pyarrow":
+            dtypes = {
+                col: dtype if dtype == "category" else f"{dtype.lower()}[pyarrow]"
+                for col, dtype in dtypes.items()
+            }
+            return pd.read_csv(
+                path, dtype=dtypes, engine="pyarrow", dtype_backend="pyarrow"
+            )
+        return pd.read_csv(path, dtype=dtypes)
+
+    @cached_property
+    def data_fingerprint(self):
+        """Hash of the reference CSVs, identifying results derived from them"""
+        digest = sha256()
+        for path in (AREA_PREST, BASE_POP):
+            digest.update(path.read_bytes())
+        return digest.hexdigest()[:16]
+
     @cached_property
     def year_range(self):
         """Get list of unique years from population data"""
@@ -50,7 +290,7 @@ class DataProcessor:
         # if year is None:
         #     return []
         return sorted(
-            self.df_pop.loc[self.df_pop["AnoBase"] == str(year), "UF"].unique()
+            self.df_pop.loc[self.df_pop["AnoBase"] == int(year), "UF"].unique()
         )
 
     def get_service_areas_for_state(self, state):
@@ -62,49 +302,234 @@ class DataProcessor:
 
     def get_population_data_for_year_state(self, year, state):
         """Get population data for a specific year and state"""
-        df_year = self.df_pop[self.df_pop["AnoBase"] == str(year)]
+        df_year = self.df_pop[self.df_pop["AnoBase"] == int(year)]
         return df_year[df_year["UF"] == state]
 
-    def get_area_population_data(self, year, state):
-        """Merge area and population data for a specific year and state"""
-        df_area_state = self.df_area[self.df_area["UF"] == state]
-        df_pop_year_state = self.get_population_data_for_year_state(year, state)
-
-        df_merged = df_area_state.merge(
-            df_pop_year_state, how="left", on=["codMun", "UF"]
+    @locked_cached_property
+    def area_population_table(self):
+        """
+        Merged area and population data of every (AnoBase, UF), stacked in a
+        single frame
+
+        Rows are grouped by year, state and AreaPrestacao (categorical), with the
+        states and their areas in the order they first appear, so every service
+        area of a year is a contiguous block of rows. coefPop, the share of each
+        municipality in the population of its state, is computed once here and
+        carried by every expansion.
+
+        Returns:
+            tuple: (DataFrame, blocks DataFrame with AnoBase, UF, AreaPrestacao
+                and the inicio/fim rows of each service area)
+        """
+        frames, year_positions = [], []
+        for position, year in enumerate(self.year_range):
+            df_pop_year = self.df_pop[self.df_pop["AnoBase"] == year]
+            df_merged = self.df_area.merge(
+                df_pop_year, how="left", on=["codMun", "UF"]
+            ).drop_duplicates()
+            df_merged["coefPop"] = df_merged["popMun"] / df_merged["popUF"]
+
+            state_codes = pd.factorize(df_merged["UF"])[0]
+            area_codes = pd.factorize(
+                pd.MultiIndex.from_arrays(
+                    [df_merged["UF"], df_merged["AreaPrestacao"]]
+                )
+            )[0]
+            frames.append(df_merged.iloc[np.lexsort((area_codes, state_codes))])
+            year_positions.append(np.full(len(df_merged), position))
+
+        df_table = pd.concat(frames, ignore_index=True)
+        year_positions = np.concatenate(year_positions)
+
+        # A block starts wherever the year, state or service area changes
+        area_codes = pd.factorize(
+            pd.MultiIndex.from_arrays([df_table["UF"], df_table["AreaPrestacao"]])
+        )[0]
+        changes = (np.diff(year_positions) != 0) | (np.diff(area_codes) != 0)
+        starts = np.flatnonzero(np.r_[True, changes])
+        stops = np.r_[starts[1:], len(df_table)]
+
+        df_blocks = pd.DataFrame(
+            {
+                "AnoBase": np.array(self.year_range)[year_positions[starts]],
+                "UF": df_table["UF"].to_numpy()[starts].astype(str),
+                "AreaPrestacao": df_table["AreaPrestacao"]
+                .to_numpy()[starts]
+                .astype(str),
+                "inicio": starts,
+                "fim": stops,
+            }
+        )
+        return df_table, df_blocks
+
+    @locked_cached_property
+    def population_lookup(self):
+        """
+        Integer population of every municipality per base year
+
+        Returns:
+            Series: popMun indexed by AnoBase and codMun
+        """
+        df_pop = self.df_pop.drop_duplicates(["AnoBase", "codMun"])
+        return df_pop.set_index(["AnoBase", "codMun"])["popMun"]
+
+    def get_municipalities_population(self, year, mun_codes):
+        """
+        Total population of a set of municipalities in a base year
+
+        Args:
+            year: Base year
+            mun_codes: codMun of the municipalities, each counted once
+
+        Returns:
+            int: Sum of popMun, skipping municipalities without data, or NaN
+                if none of them has data
+        """
+        mun_codes = pd.unique(np.asarray(mun_codes, dtype="int64"))
+        keys = pd.MultiIndex.from_arrays(
+            [np.full(len(mun_codes), int(year)), mun_codes]
+        )
+        total = self.population_lookup.reindex(keys).sum(min_count=1)
+        return np.nan if pd.isna(total) else int(total)
+
+    @locked_cached_property
+    def area_population_index(self):
+        """
+        Pre-merged area and population data for every (AnoBase, UF), as views
+        of area_population_table
+
+        Returns:
+            dict: (year, state) -> (DataFrame, {service_area: (start, stop)})
+        """
+        df_table, df_blocks = self.area_population_table
+        index = {}
+        for (year, state), df_state_blocks in df_blocks.groupby(
+            ["AnoBase", "UF"], sort=False
+        ):
+            start = df_state_blocks["inicio"].iloc[0]
+            stop = df_state_blocks["fim"].iloc[-1]
+            offsets = {
+                area: (inicio - start, fim - start)
+                for area, inicio, fim in df_state_blocks[
+                    ["AreaPrestacao", "inicio", "fim"]
+                ].itertuples(index=False)
+            }
+            index[(int(year), state)] = (df_table.iloc[start:stop], offsets)
+
+        return index
+
+    def _area_rows(self, df_keys):
+        """
+        Rows of area_population_table for each service area in df_keys
+
+        Args:
+            df_keys: DataFrame with an integer `id` column and the AnoBase, UF
+                and AreaPrestacao to look up
+
+        Returns:
+            tuple: (ids, row positions), in the order of df_keys
+        """
+        _, df_blocks = self.area_population_table
+        df_keys = df_keys.merge(
+            df_blocks, how="inner", on=["AnoBase", "UF", "AreaPrestacao"]
+        )
+        starts = df_keys["inicio"].to_numpy()
+        stops = df_keys["fim"].to_numpy()
+        return np.repeat(df_keys["id"].to_numpy(), stops - starts), _expand_ranges(
+            starts, stops
         )
 
-        return df_merged.drop_duplicates()
+    def warm_up(self):
+        """Build every lazy index now instead of on the first lookup"""
+        self.year_range
+        self.area_population_index
+        self.exclusion_area_lattice
+        self.population_lookup
+        return self
+
+    def memory_usage(self):
+        """
+        Memory held by the reference tables and by the indexes built so far
+
+        Returns:
+            dict: Bytes per component
+        """
+        usage = {
+            "df_area": self.df_area.memory_usage(deep=True).sum(),
+            "df_pop": self.df_pop.memory_usage(deep=True).sum(),
+        }
+        if "area_population_table" in self.__dict__:
+            df_table, df_blocks = self.area_population_table
+            usage["area_population_table"] = _frame_nbytes(df_table) + _frame_nbytes(
+                df_blocks
+            )
+        return usage
+
+    def _area_population_entry(self, year, state):
+        """Look up the indexed frame and area offsets for a year and state"""
+        entry = self.area_population_index.get((int(year), state))
+        if entry is None:
+            df_any, _ = next(iter(self.area_population_index.values()))
+            return df_any.iloc[:0], {}
+        return entry
+
+    @timed(rows=len)
+    def get_area_population_data(self, year, state):
+        """Merge area and population data for a specific year and state"""
+        df_merged, _ = self._area_population_entry(year, state)
+        return df_merged
 
     def get_service_area_data(self, year, state, service_area):
         """Get data for a specific service area"""
-        df_area_pop = self.get_area_population_data(year, state)
-        return df_area_pop[df_area_pop["AreaPrestacao"] == str(service_area)]
-
+        df_area_pop, offsets = self._area_population_entry(year, state)
+        start, stop = offsets.get(str(service_area), (0, 0))
+        return df_area_pop.iloc[start:stop]
+
+    @locked_cached_property
+    def exclusion_area_lattice(self):
+        """
+        Strict-subset relation between the service areas of every state
+
+        The municipalities of each area are held as a bitset over the state's
+        municipalities. Area membership does not depend on the base year, so
+        the relation is built per state and serves every year.
+
+        Returns:
+            dict: state -> {service_area: [areas strictly contained in it]}
+        """
+        lattice = {}
+        for state, df_state in self.df_area.groupby("UF", sort=False, observed=True):
+            mun_positions = pd.factorize(df_state["codMun"])[0]
+            n_municipalities = mun_positions.max() + 1
+
+            bitsets = {}
+            for area, positions in pd.Series(mun_positions).groupby(
+                df_state["AreaPrestacao"].to_numpy(), sort=False
+            ):
+                mask = np.zeros(n_municipalities, dtype=bool)
+                mask[positions.to_numpy()] = True
+                bitsets[area] = int.from_bytes(
+                    np.packbits(mask, bitorder="little").tobytes(), "little"
+                )
+
+            lattice[state] = {
+                main: [
+                    area
+                    for area, bits in bitsets.items()
+                    if area not in ("Toda UF", main)
+                    and bits | main_bits == main_bits
+                    and bits != main_bits
+                ]
+                for main, main_bits in bitsets.items()
+            }
+
+        return lattice
+
+    @timed(rows=len)
     def get_exclusion_areas(self, year, state, main_service_area):
         """Get eligible exclusion areas for a service area"""
-        df_area_pop = self.get_area_population_data(year, state)
-        df_main_area = self.get_service_area_data(year, state, main_service_area)
-
-        # Get all areas except the main one and 'Toda UF'
-        exclude = ["Toda UF", main_service_area]
-        all_areas = [
-            x for x in df_area_pop["AreaPrestacao"].unique() if x not in exclude
-        ]
-
-        # Create set of municipalities in the main service area
-        main_area_mun_codes = set(df_main_area["codMun"])
-
-        # Find eligible exclusion areas (those that are subsets of the main area)
-        eligible_areas = []
-        for area in all_areas:
-            df_area = df_area_pop[df_area_pop["AreaPrestacao"] == area]
-            area_mun_codes = set(df_area["codMun"])
-
-            if area_mun_codes < main_area_mun_codes:
-                eligible_areas.append(area)
-
-        return eligible_areas
+        areas_by_state = self.exclusion_area_lattice.get(state, {})
+        return list(areas_by_state.get(main_service_area, []))
 
     def exclude_areas_from_df(self, area_prestacao, year, state, areas_a_excluir: str):
         """Apply exclusion areas to a service area dataframe and returns a list of municipalities"""
@@ -139,46 +564,225 @@ class DataProcessor:
 
         return df_service_area.loc[~df_service_area["codMun"].isin(cidades_a_excluir)]
 
-    def gerar_tabela_final(self, df):
-        """Generate the final dataframe for a term"""
-        final_rows = []
-        for row in df.itertuples():
-            year_base = row.AnoBase
-            state = row.UF
-            area_prestacao = row.AreaPrestacao
-            areas_exclusao = row.AreaExclusao
-            municipios_exclusao = row.MunicipioExclusao
-
-            # Apply exclusions
-            tabela_com_areas_excluidas = self.exclude_areas_from_df(
-                area_prestacao, year_base, state, areas_exclusao
+    def _expand_areas(self, df_areas):
+        """
+        Rows of area_population_table for each area in df_areas, without the
+        municipalities of its exclusion areas and its excluded municipalities
+
+        Returns:
+            tuple: (ids, row positions), grouped by id in the order of df_areas
+        """
+        df_table, _ = self.area_population_table
+        ids, positions = self._area_rows(df_areas)
+        cod_mun = df_table["codMun"].to_numpy()
+        municipio = df_table["Municipio"].to_numpy()
+
+        # Anti-join the municipalities of the exclusion areas
+        df_excluded_areas = df_areas.assign(
+            AreaPrestacao=df_areas["AreaExclusao"].str.split(", ")
+        ).explode("AreaPrestacao")
+        excluded_ids, excluded_positions = self._area_rows(df_excluded_areas)
+        keep = ~pd.MultiIndex.from_arrays([ids, cod_mun[positions]]).isin(
+            pd.MultiIndex.from_arrays([excluded_ids, cod_mun[excluded_positions]])
+        )
+
+        # Anti-join the excluded municipalities
+        df_excluded_cities = df_areas.assign(
+            Municipio=df_areas["MunicipioExclusao"].str.split(", ")
+        ).explode("Municipio")
+        keep &= ~pd.MultiIndex.from_arrays([ids, municipio[positions]]).isin(
+            pd.MultiIndex.from_arrays(
+                [df_excluded_cities["id"], df_excluded_cities["Municipio"]]
+            )
+        )
+        return ids[keep], positions[keep]
+
+    def _area_positions(self, df_areas, cache=None):
+        """
+        Expanded rows of every area in df_areas, taking the areas already in
+        the cache from it and evicting the ones df_areas no longer uses
+
+        Returns:
+            list: Row positions of each area, in the order of df_areas
+        """
+        keys = list(df_areas[AREA_KEY_COLUMNS].itertuples(index=False, name=None))
+        expanded = {} if cache is None else cache.positions
+
+        is_missing = [key not in expanded for key in keys]
+        if any(is_missing):
+            df_missing = df_areas[is_missing]
+            ids, positions = self._expand_areas(df_missing)
+            missing_ids = df_missing["id"].to_numpy()
+            bounds = zip(
+                np.searchsorted(ids, missing_ids, side="left"),
+                np.searchsorted(ids, missing_ids, side="right"),
             )
-            tabela_final = self.exclude_cities_from_df(
-                tabela_com_areas_excluidas, municipios_exclusao
+            missing_keys = (key for key, missing in zip(keys, is_missing) if missing)
+            for key, (start, stop) in zip(missing_keys, bounds):
+                expanded[key] = positions[start:stop]
+
+        if cache is not None:
+            for key in expanded.keys() - set(keys):
+                del expanded[key]
+
+        return [expanded[key] for key in keys]
+
+    @timed(rows=len)
+    def gerar_tabela_final(self, df, cache=None, row_hashes=None):
+        """
+        Generate the final dataframe for a term
+
+        Args:
+            df: DataFrame with the terms
+            cache: Optional AreaExpansionCache of the session's term table. Only
+                terms missing from it are expanded, the rows of the others are
+                taken from the previous result, and an unchanged table returns
+                the previous result, which must not be modified
+            row_hashes: Hash of each row of df, e.g. from term_row_hashes, so
+                the rows are not hashed again. Only used with a cache
+
+        Returns:
+            DataFrame: One row per term and municipality, with the term's
+                Banda / FrequenciaCentral as the float column BW_Freq
+        """
+        if cache is None:
+            return self.expand_terms(df)[0]
+
+        if row_hashes is None:
+            row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        if cache.result is not None and np.array_equal(row_hashes, cache.row_hashes):
+            return cache.result
+
+        hashes = row_hashes.tolist()
+        # Identical terms expand to the same rows, which are kept only once
+        is_first = np.zeros(len(hashes), dtype=bool)
+        is_first[np.unique(row_hashes, return_index=True)[1]] = True
+        is_new = is_first & np.array(
+            [row_hash not in cache.term_ranges for row_hash in hashes], dtype=bool
+        )
+
+        # Only the new terms are expanded, their rows appended to the previous
+        # result
+        df_rows = cache.result
+        term_ranges = dict(cache.term_ranges)
+        if is_new.any() or df_rows is None:
+            new_positions = np.flatnonzero(is_new)
+            df_new, term_rows = self.expand_terms(df.iloc[new_positions], cache)
+            offset = 0 if df_rows is None else len(df_rows)
+            # The rows of each term are contiguous and in term order
+            starts = np.searchsorted(term_rows, np.arange(len(new_positions))) + offset
+            stops = np.append(starts[1:], offset + len(term_rows))
+            for position, start, stop in zip(new_positions, starts, stops):
+                term_ranges[hashes[position]] = (int(start), int(stop))
+            df_rows = df_new if df_rows is None else pd.concat([df_rows, df_new])
+
+        starts, stops = (
+            np.array([term_ranges[row_hash] for row_hash in hashes], dtype=int)
+            .reshape(-1, 2)
+            .T
+        )
+        # Row labels are those of the expansion with the repeated terms
+        lengths = stops - starts
+        label_starts = np.cumsum(lengths) - lengths
+        positions = _expand_ranges(starts[is_first], stops[is_first])
+        if len(positions) != len(df_rows) or np.any(np.diff(positions) != 1):
+            # Terms were removed or reordered, otherwise every row is kept
+            df_rows = df_rows.take(positions)
+        df_final = df_rows.set_axis(
+            _expand_ranges(
+                label_starts[is_first], label_starts[is_first] + lengths[is_first]
+            ),
+            copy=False,
+        )
+
+        kept_lengths = lengths[is_first]
+        kept_starts = np.cumsum(kept_lengths) - kept_lengths
+        cache.term_ranges = {
+            row_hash: (start, start + length)
+            for row_hash, start, length in zip(
+                row_hashes[is_first].tolist(),
+                kept_starts.tolist(),
+                kept_lengths.tolist(),
             )
+        }
+        cache.row_hashes, cache.result = row_hashes, df_final
+        return df_final
+
+    def expand_terms(self, df, cache=None):
+        """
+        Same as gerar_tabela_final, without reusing a previous result
+
+        Returns:
+            tuple: (DataFrame, position in df of the term of each row)
+        """
+        df_table, _ = self.area_population_table
+        df_terms = df.reset_index(drop=True)
+
+        # The municipalities of a term depend only on these columns, so every
+        # distinct combination is expanded once and shared by its terms
+        df_areas = pd.DataFrame(
+            {
+                "AnoBase": pd.to_numeric(df_terms["AnoBase"], errors="coerce"),
+                "UF": df_terms["UF"].astype(str),
+                "AreaPrestacao": df_terms["AreaPrestacao"].astype(str),
+                "AreaExclusao": df_terms["AreaExclusao"].fillna(""),
+                "MunicipioExclusao": df_terms["MunicipioExclusao"].fillna(""),
+            }
+        )
+        area_ids = (
+            df_areas.groupby(AREA_KEY_COLUMNS, sort=False, dropna=False)
+            .ngroup()
+            .to_numpy()
+        )
+        df_areas = df_areas.assign(id=area_ids).drop_duplicates("id")
+
+        area_positions = self._area_positions(df_areas, cache)
+        positions = np.concatenate([np.zeros(0, dtype=int)] + area_positions)
+        area_lengths = np.array([len(p) for p in area_positions], dtype=int)
+
+        # Repeat each area's rows for every term using it, in term order
+        area_starts = np.cumsum(area_lengths) - area_lengths
+        term_lengths = area_lengths[area_ids]
+        rows = positions[
+            _expand_ranges(area_starts[area_ids], area_starts[area_ids] + term_lengths)
+        ]
+        term_rows = np.repeat(np.arange(len(df_terms)), term_lengths)
+
+        term_columns = [
+            "AreaExclusao",
+            "MunicipioExclusao",
+            "AnoBase",
+            "Entidade",
+            "NumTermo",
+            "AnoTermo",
+            "FrequenciaInicial",
+            "FrequenciaFinal",
+            "FrequenciaCentral",
+            "Banda",
+            "Tipo",
+        ]
+        df_terms = df_terms.assign(
+            AnoBase=df_terms["AnoBase"].astype(str), BW_Freq=bandwidth_ratio(df_terms)
+        )
 
-            tabela_final["AreaExclusao"] = areas_exclusao
-            tabela_final["MunicipioExclusao"] = municipios_exclusao
-            tabela_final["AnoBase"] = str(year_base)
-            tabela_final["Entidade"] = row.Entidade
-            tabela_final["NumTermo"] = row.NumTermo
-            tabela_final["AnoTermo"] = row.AnoTermo
-            tabela_final[ "FrequenciaInicial"] = row.FrequenciaInicial
-            tabela_final["FrequenciaFinal"] = row.FrequenciaFinal
-            tabela_final["FrequenciaCentral"] = row.FrequenciaCentral
-            tabela_final["Banda"] = row.Banda
-            tabela_final["Tipo"] = row.Tipo
-            final_rows.append(tabela_final)
-
-        return pd.concat(final_rows, ignore_index=True).drop_duplicates()
-
-    # def load_map(self, state):
-    #     """Load map data for a specific state"""
-    #     try:
-    #         return gpd.read_file(f"SHP_UFs/{state}.shp")
-    #     except Exception as e:
-    #         print(f"Error loading map for state {state}: {e}")
-    #         return None
+        # Rows of different terms never coincide and identical terms expand to
+        # identical rows, so the duplicates are dropped per term rather than
+        # over the expanded table. Row labels are those of the full expansion.
+        duplicated = df_terms[["UF", "AreaPrestacao"] + term_columns].duplicated()
+        kept = ~duplicated.to_numpy()[term_rows]
+        term_rows = term_rows[kept]
+
+        df_final = (
+            df_table.take(rows[kept])
+            .set_axis(np.flatnonzero(kept), copy=False)
+            .assign(
+                **{
+                    col: df_terms[col].to_numpy()[term_rows]
+                    for col in term_columns + ["BW_Freq"]
+                }
+            )
+        )
+        return df_final, term_rows
 
     def calculate_onus(
         self, year_base, entity, state, term_num, term_year, rol_uf, df_data
@@ -199,25 +803,29 @@ class DataProcessor:
             df_count_freq, how="inner", on="FrequenciaCentral"
         )
 
-        # Filter for entity, state, and term
-        df_entity = df_data_count_freq[df_data_count_freq["Entidade"] == entity]
-        df_state = df_entity[df_entity["UF"] == state]
-        df_term_num = df_state[df_state["NumTermo"] == term_num]
-        df_term = df_term_num[df_term_num["AnoTermo"] == term_year]
+        # Calculate bandwidth/frequency ratio on the merged frame, which owns
+        # its data, so the filtered frames below are never assigned to
+        df_data_count_freq["BW_Freq"] = (
+            df_data_count_freq["Banda"] / df_data_count_freq["FrequenciaCentral"]
+        )
 
-        # Calculate bandwidth/frequency ratio
-        df_term["BW_Freq"] = df_term["Banda"] / df_term["FrequenciaCentral"]
+        # Filter for entity, state, and term
+        is_entity_state = (df_data_count_freq["Entidade"] == entity) & (
+            df_data_count_freq["UF"] == state
+        )
+        df_term = df_data_count_freq[
+            is_entity_state
+            & (df_data_count_freq["NumTermo"] == term_num)
+            & (df_data_count_freq["AnoTermo"] == term_year)
+        ]
 
         # Get list of municipalities in the term
         mun_codes = list(df_term["codMun"].unique())
 
         # Get other terms for comparison
-        df_other_entity = df_data_count_freq[df_data_count_freq["Entidade"] == entity]
-        df_other_state = df_other_entity[df_other_entity["UF"] == state]
-        df_other_terms = df_other_state[df_other_state["NumTermo"] != term_num]
-        df_other_terms["BW_Freq"] = (
-            df_other_terms["Banda"] / df_other_terms["FrequenciaCentral"]
-        )
+        df_other_terms = df_data_count_freq[
+            is_entity_state & (df_data_count_freq["NumTermo"] != term_num)
+        ]
 
         # Calculate factors for each municipality
         df_factors = pd.DataFrame()
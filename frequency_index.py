@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+
+from calculations import TERM_KEYS
+from data_processor import _expand_ranges
+
+GROUP_KEYS = ["UF", "codMun"]
+# Subtrees up to this height are scanned linearly instead of descended
+_LEAF_HEIGHT = 3
+
+
+class FrequencyIntervalIndex:
+    """
+    Index of the frequency ranges (FrequenciaInicial to FrequenciaFinal) of the
+    terms in each municipality, to find the terms sharing spectrum
+
+    Ranges are half-open, so adjacent ranges such as 703-708 and 708-713 do not
+    overlap. The ranges of each (UF, codMun) are sorted by start and stored as
+    an implicit interval tree, a binary search tree laid over the sorted array
+    where every node also keeps the largest end of its subtree, so a query
+    visits O(log n + k) nodes for k matches.
+    """
+
+    def __init__(self, df_data, group_keys=GROUP_KEYS):
+        """
+        Build the index from the expanded term table
+
+        Args:
+            df_data: DataFrame from DataProcessor.gerar_tabela_final. Rows
+                without a valid frequency range are left out
+            group_keys: Columns identifying a municipality
+        """
+        self.group_keys = list(group_keys)
+        starts = pd.to_numeric(df_data["FrequenciaInicial"], errors="coerce")
+        stops = pd.to_numeric(df_data["FrequenciaFinal"], errors="coerce")
+        is_valid = (starts < stops).fillna(False).to_numpy(dtype=bool)
+        self.df_data = df_data[is_valid]
+
+        group_ids = (
+            self.df_data.groupby(self.group_keys, sort=False, observed=True)
+            .ngroup()
+            .to_numpy()
+        )
+        starts = starts.to_numpy(dtype=float)[is_valid]
+        stops = stops.to_numpy(dtype=float)[is_valid]
+        order = np.lexsort((starts, group_ids))
+        self._group_ids = group_ids[order]
+        self._rows = order
+        self._starts = starts[order]
+        self._stops = stops[order]
+
+        # Row range of each group in the sorted arrays
+        group_bounds = np.flatnonzero(np.diff(self._group_ids)) + 1
+        offsets = np.concatenate([[0], group_bounds, [len(order)]])
+        df_groups = self.df_data.iloc[order[offsets[:-1]]][self.group_keys]
+        self._groups = {
+            key: (int(offset), int(stop))
+            for key, offset, stop in zip(
+                df_groups.itertuples(index=False, name=None),
+                offsets[:-1],
+                offsets[1:],
+            )
+        }
+
+        starts, stops = self._starts.tolist(), self._stops.tolist()
+        self._max_stops = list(stops)
+        self._heights = {
+            key: self._build_tree(starts, stops, offset, stop)
+            for key, (offset, stop) in self._groups.items()
+        }
+        self._starts_list, self._stops_list = starts, stops
+
+    def _build_tree(self, starts, stops, offset, stop):
+        """
+        Fill the subtree maximum ends of one group, whose sorted ranges are at
+        positions offset to stop
+
+        Node i of height k covers positions i - 2**k + 1 to i + 2**k - 1, and
+        leaves are the even positions. Nodes to the right of the last position
+        do not exist, so their maximum end is carried by `last`.
+
+        Returns:
+            int: Height of the root
+        """
+        max_stops = self._max_stops
+        n = stop - offset
+        last_i = last = 0
+        for i in range(0, n, 2):
+            last_i, last = i, stops[offset + i]
+
+        height = 1
+        while 1 << height <= n:
+            half = 1 << (height - 1)
+            for i in range((half << 1) - 1, n, half << 2):
+                right = max_stops[offset + i + half] if i + half < n else last
+                max_stops[offset + i] = max(
+                    stops[offset + i], max_stops[offset + i - half], right
+                )
+            last_i = last_i - half if last_i >> height & 1 else last_i + half
+            if last_i < n and max_stops[offset + last_i] > last:
+                last = max_stops[offset + last_i]
+            height += 1
+        return height - 1
+
+    def _overlapping_positions(self, key, start, stop):
+        """Sorted positions of the ranges of a municipality overlapping [start, stop)"""
+        if key not in self._groups:
+            return []
+        offset, group_stop = self._groups[key]
+        n = group_stop - offset
+        starts, stops = self._starts_list, self._stops_list
+        max_stops = self._max_stops
+
+        positions = []
+        height = self._heights[key]
+        # Top-down traversal; (node, height, left child visited)
+        stack = [((1 << height) - 1, height, False)]
+        while stack:
+            node, height, left_done = stack.pop()
+            if height <= _LEAF_HEIGHT:
+                # Small subtree, scan its positions in order
+                first = node >> height << height
+                for i in range(first, min(first + (1 << (height + 1)) - 1, n)):
+                    if starts[offset + i] >= stop:
+                        break
+                    if start < stops[offset + i]:
+                        positions.append(offset + i)
+            elif not left_done:
+                left = node - (1 << (height - 1))
+                stack.append((node, height, True))
+                if left >= n or max_stops[offset + left] > start:
+                    stack.append((left, height - 1, False))
+            elif node < n and starts[offset + node] < stop:
+                if start < stops[offset + node]:
+                    positions.append(offset + node)
+                stack.append((node + (1 << (height - 1)), height - 1, False))
+        return positions
+
+    def overlapping(self, key, start, stop):
+        """
+        Terms of a municipality whose range overlaps [start, stop)
+
+        Args:
+            key: Values of group_keys, e.g. (UF, codMun)
+            start: Start of the queried range
+            stop: End of the queried range
+
+        Returns:
+            DataFrame: Matching rows of df_data, sorted by FrequenciaInicial
+        """
+        positions = self._overlapping_positions(key, start, stop)
+        return self.df_data.iloc[self._rows[positions]]
+
+    def containing(self, key, start, stop):
+        """Terms of a municipality whose range contains all of [start, stop)"""
+        positions = [
+            i
+            for i in self._overlapping_positions(key, start, stop)
+            if self._starts_list[i] <= start and self._stops_list[i] >= stop
+        ]
+        return self.df_data.iloc[self._rows[positions]]
+
+    def contained_in(self, key, start, stop):
+        """Terms of a municipality whose range lies within [start, stop)"""
+        if key not in self._groups:
+            return self.df_data.iloc[[]]
+        offset, group_stop = self._groups[key]
+        # Ranges starting inside [start, stop) are contiguous in the sorted order
+        first, last = offset + np.searchsorted(
+            self._starts[offset:group_stop], [start, stop]
+        )
+        positions = first + np.flatnonzero(self._stops[first:last] <= stop)
+        return self.df_data.iloc[self._rows[positions]]
+
+    def conflicting_pairs(self, columns=TERM_KEYS):
+        """
+        Every pair of terms sharing spectrum in the same municipality
+
+        A sweep over the sorted ranges pairs each range with the ones starting
+        before it ends, for all municipalities at once.
+
+        Args:
+            columns: Columns of df_data identifying a term, reported for both
+                sides of the pair with the suffixes _a and _b
+
+        Returns:
+            DataFrame: One row per pair with the group keys, the columns of both
+                terms and the shared range (inicioSobreposicao, fimSobreposicao)
+        """
+        # Ranks keep the (group, start) search keys exact integers
+        unique_starts = np.unique(self._starts)
+        width = len(unique_starts) + 1
+        keys = self._group_ids * width + np.searchsorted(unique_starts, self._starts)
+        bounds = np.searchsorted(
+            keys,
+            self._group_ids * width + np.searchsorted(unique_starts, self._stops),
+        )
+
+        first = np.arange(len(keys))
+        counts = bounds - first - 1
+        left = np.repeat(first, counts)
+        right = _expand_ranges(first + 1, bounds)
+
+        df_left = self.df_data.iloc[self._rows[left]]
+        df_right = self.df_data.iloc[self._rows[right]]
+        df_pairs = df_left[self.group_keys].reset_index(drop=True)
+        for suffix, df_side in (("_a", df_left), ("_b", df_right)):
+            for col in columns:
+                df_pairs[col + suffix] = df_side[col].to_numpy()
+        df_pairs["inicioSobreposicao"] = self._starts[right]
+        df_pairs["fimSobreposicao"] = np.minimum(self._stops[left], self._stops[right])
+        return df_pairs
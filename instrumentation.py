@@ -0,0 +1,213 @@
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Durations kept per function for the percentiles
+SAMPLE_SIZE = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+METRIC_PREFIX = "onus"
+
+
+class _Stats:
+    """Accumulated measurements of one function"""
+
+    __slots__ = ("calls", "seconds", "rows", "samples")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+
+class MetricsRegistry:
+    """
+    Call counts, latencies and row counts of the instrumented functions
+
+    Functions are measured with the timed decorator or the measure context
+    manager. While disabled, both only check the enabled flag, so they can stay
+    on the hot paths. The registry is shared by every thread; the measurements
+    of a single Streamlit rerun are also collected per thread between
+    start_run and run_timings, and add_run_timings brings in those of the
+    threads working for it.
+    """
+
+    def __init__(self, enabled=False):
+        """
+        Args:
+            enabled: Whether measurements are recorded
+        """
+        self.enabled = enabled
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, name, seconds, rows=None):
+        """
+        Add one measurement
+
+        Args:
+            name: Name of the measured function
+            seconds: Duration of the call
+            rows: Number of rows produced, if meaningful
+        """
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _Stats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.rows += rows or 0
+            stats.samples.append(seconds)
+        run = getattr(self._local, "run", None)
+        if run is not None:
+            run.append((name, seconds, rows))
+
+    def timed(self, name=None, rows=None):
+        """
+        Decorator measuring every call of a function
+
+        Args:
+            name: Name of the measurements. Defaults to the qualified name of
+                the function, e.g. DataProcessor.gerar_tabela_final
+            rows: Function of the return value giving the number of rows,
+                e.g. len
+
+        Returns:
+            Callable: The decorator
+        """
+
+        def decorator(func):
+            label = name or func.__qualname__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                seconds = time.perf_counter() - start
+                self.record(label, seconds, rows(result) if rows else None)
+                return result
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Measure a block of code
+
+        The yielded dict accepts a "rows" entry with the rows produced. Blocks
+        raising an exception are not recorded.
+
+        Args:
+            name: Name of the measurements
+        """
+        if not self.enabled:
+            yield {}
+            return
+        info = {}
+        start = time.perf_counter()
+        yield info
+        self.record(name, time.perf_counter() - start, info.get("rows"))
+
+    def start_run(self):
+        """Start collecting the measurements of the current thread"""
+        self._local.run = []
+
+    def run_timings(self):
+        """
+        Measurements of the current thread since start_run
+
+        Returns:
+            list: (name, seconds, rows) of each call, in order
+        """
+        return list(getattr(self._local, "run", None) or [])
+
+    def add_run_timings(self, timings):
+        """
+        Add measurements taken by another thread, e.g. a background job, to
+        the run of the current thread, if started
+
+        Args:
+            timings: (name, seconds, rows) of each call, as from run_timings
+        """
+        run = getattr(self._local, "run", None)
+        if run is not None:
+            run.extend(timings)
+
+    def reset(self):
+        """Drop every measurement"""
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """
+        Summary of the measurements of each function
+
+        Returns:
+            dict: name -> calls, total and mean seconds, the QUANTILES of the
+                last SAMPLE_SIZE durations, the largest duration and total rows
+        """
+        with self._lock:
+            items = [
+                (name, stats.calls, stats.seconds, stats.rows, list(stats.samples))
+                for name, stats in self._stats.items()
+            ]
+        summary = {}
+        for name, calls, seconds, rows, samples in sorted(items):
+            summary[name] = {
+                "calls": calls,
+                "seconds": seconds,
+                "mean_seconds": seconds / calls,
+                **{
+                    f"p{round(q * 100)}_seconds": float(value)
+                    for q, value in zip(QUANTILES, np.quantile(samples, QUANTILES))
+                },
+                "max_seconds": max(samples),
+                "rows": rows,
+            }
+        return summary
+
+    def to_json(self, indent=2):
+        """Snapshot as a JSON document"""
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def to_prometheus(self):
+        """
+        Snapshot in the Prometheus text exposition format: a summary of the
+        durations and a counter of rows, labeled by function
+        """
+        seconds = f"{METRIC_PREFIX}_function_seconds"
+        rows = f"{METRIC_PREFIX}_function_rows_total"
+        lines = [
+            f"# HELP {seconds} Duration of the instrumented functions",
+            f"# TYPE {seconds} summary",
+        ]
+        snapshot = self.snapshot()
+        for name, stats in snapshot.items():
+            label = f'function="{name}"'
+            for q in QUANTILES:
+                value = stats[f"p{round(q * 100)}_seconds"]
+                lines.append(f'{seconds}{{{label},quantile="{q}"}} {value}')
+            lines.append(f"{seconds}_sum{{{label}}} {stats['seconds']}")
+            lines.append(f"{seconds}_count{{{label}}} {stats['calls']}")
+        lines += [
+            f"# HELP {rows} Rows produced by the instrumented functions",
+            f"# TYPE {rows} counter",
+        ]
+        for name, stats in snapshot.items():
+            lines.append(f'{rows}{{function="{name}"}} {stats["rows"]}')
+        return "\n".join(lines) + "\n"
+
+
+# Registry of the application, enabled by setting ONUS_METRICS
+metrics = MetricsRegistry(enabled=bool(os.environ.get("ONUS_METRICS")))
+timed = metrics.timed
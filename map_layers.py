@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+
+from data_processor import CACHE_DIR, ROOT
+from shapefile_reader import ShapefileReader
+
+SHP_DIR = ROOT / "SHP_UFs"
+MAP_CACHE_DIR = CACHE_DIR / "maps"
+# Simplification tolerances, in degrees, from the most to the least detailed
+MAP_TOLERANCES = (0.001, 0.01, 0.05)
+DEFAULT_TOLERANCE = 0.01
+MAP_LAYER_CACHE_SIZE = 16
+FEATURE_PROPERTIES = ["geocodigo", "nome"]
+
+
+def available_states(shp_dir=SHP_DIR):
+    """States with a complete shapefile, since some UFs ship only .dbf/.shx"""
+    return sorted(
+        path.stem
+        for path in shp_dir.glob("*.shp")
+        if path.with_suffix(".dbf").exists() and path.with_suffix(".shx").exists()
+    )
+
+
+class MapLayer:
+    """
+    Simplified municipality outlines of a state at one tolerance, indexed by
+    geocodigo
+    """
+
+    def __init__(self, state, tolerance, feature_collection):
+        """
+        Args:
+            state: State code (UF)
+            tolerance: Simplification tolerance of the outlines
+            feature_collection: GeoJSON FeatureCollection with a bbox and the
+                geocodigo of each feature in its properties
+        """
+        self.state = state
+        self.tolerance = tolerance
+        self.feature_collection = feature_collection
+        self.bounds = feature_collection["bbox"]
+        self.features = {
+            feature["properties"]["geocodigo"]: feature
+            for feature in feature_collection["features"]
+        }
+
+    def select(self, mun_codes):
+        """
+        Outlines of some municipalities
+
+        Args:
+            mun_codes: Municipality codes (geocodigo), as int or str. Codes
+                without an outline are ignored
+
+        Returns:
+            dict: GeoJSON FeatureCollection
+        """
+        features = self.features
+        return {
+            "type": "FeatureCollection",
+            "features": [
+                features[code]
+                for code in dict.fromkeys(str(code) for code in mun_codes)
+                if code in features
+            ],
+        }
+
+
+class MapLayerCache:
+    """
+    Simplified outlines of the states, precomputed on disk and kept in memory
+
+    The shapefile of a state is read and simplified once for every tolerance in
+    MAP_TOLERANCES, and each result is saved as GeoJSON in cache_dir, keyed by
+    the contents of the shapefile and the tolerance. Loaded layers are kept in
+    an LRU of cache_size entries, so showing another term of a state only
+    selects its features by geocodigo.
+    """
+
+    def __init__(
+        self,
+        shp_dir=SHP_DIR,
+        cache_dir=MAP_CACHE_DIR,
+        tolerances=MAP_TOLERANCES,
+        cache_size=MAP_LAYER_CACHE_SIZE,
+    ):
+        """
+        Args:
+            shp_dir: Folder with a {UF}.shp shapefile per state
+            cache_dir: Folder of the GeoJSON files
+            tolerances: Tolerances precomputed when a state is first read
+            cache_size: Number of layers kept in memory
+        """
+        self.shp_dir = shp_dir
+        self.cache_dir = cache_dir
+        self.tolerances = tuple(tolerances)
+        self.cache_size = cache_size
+        self._layers = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def available_states(self):
+        """States with a complete shapefile"""
+        return available_states(self.shp_dir)
+
+    def layer(self, state, tolerance=DEFAULT_TOLERANCE):
+        """
+        Outlines of the municipalities of a state
+
+        Args:
+            state: State code (UF)
+            tolerance: Simplification tolerance, one of the precomputed ones
+
+        Returns:
+            MapLayer: The layer, or None if the state has no shapefile or it
+                could not be read
+        """
+        key = (state, tolerance)
+        with self._lock:
+            if key in self._layers:
+                self._layers.move_to_end(key)
+                return self._layers[key]
+
+        # Loaded outside the lock, so a miss does not block other sessions
+        try:
+            feature_collection = self._load(state, tolerance)
+        except Exception as e:
+            print(f"Error loading map for state {state}: {e}")
+            return None
+        if feature_collection is None:
+            return None
+
+        layer = MapLayer(state, tolerance, feature_collection)
+        with self._lock:
+            self._layers[key] = layer
+            self._layers.move_to_end(key)
+            while len(self._layers) > self.cache_size:
+                self._layers.popitem(last=False)
+        return layer
+
+    def clear_cache(self):
+        """Drop every layer kept in memory"""
+        with self._lock:
+            self._layers.clear()
+
+    def _load(self, state, tolerance):
+        """GeoJSON of a layer from the disk cache, building it on a miss"""
+        shp_path = self.shp_dir / f"{state}.shp"
+        if not shp_path.exists():
+            return None
+
+        cache_path = self._cache_path(state, tolerance)
+        if cache_path.exists():
+            try:
+                with open(cache_path, encoding="utf-8") as f:
+                    return json.load(f)
+            except ValueError:
+                # Unreadable file, replaced by the layer rebuilt below
+                pass
+        return self.precompute(state, sorted({tolerance, *self.tolerances}))[
+            tolerance
+        ]
+
+    def _cache_path(self, state, tolerance):
+        """GeoJSON file of a layer, keyed by the shapefile contents"""
+        if state not in self._digests:
+            digest = sha256()
+            for suffix in (".shp", ".shx", ".dbf"):
+                digest.update((self.shp_dir / f"{state}{suffix}").read_bytes())
+            self._digests[state] = digest.hexdigest()[:16]
+        key = self._digests[state]
+        return self.cache_dir / f"{state}-{tolerance:g}-{key}.geojson"
+
+    def precompute(self, state, tolerances=None):
+        """
+        Read the shapefile of a state once and save its layer at each tolerance
+
+        Args:
+            state: State code (UF)
+            tolerances: Tolerances to save. Defaults to self.tolerances
+
+        Returns:
+            dict: GeoJSON FeatureCollection of each tolerance
+        """
+        collections = {}
+        with ShapefileReader(self.shp_dir / f"{state}.shp") as reader:
+            for tolerance in tolerances or self.tolerances:
+                feature_collection = {
+                    "type": "FeatureCollection",
+                    "bbox": reader.bbox,
+                    "features": reader.features(
+                        tolerance=tolerance, properties=FEATURE_PROPERTIES
+                    ),
+                }
+                collections[tolerance] = feature_collection
+                self._write(self._cache_path(state, tolerance), feature_collection)
+        return collections
+
+    def _write(self, path, feature_collection):
+        """Save a layer, replacing older files of the same state and tolerance"""
+        tmp_path = None
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            prefix = path.stem.rsplit("-", 1)[0]
+            for stale in self.cache_dir.glob(f"{prefix}-*.geojson"):
+                if stale != path:
+                    stale.unlink(missing_ok=True)
+            # Written under a temporary name unique to this writer, so
+            # concurrent readers never see a partial file and concurrent
+            # writers never write to the same one
+            with tempfile.NamedTemporaryFile(
+                "w",
+                encoding="utf-8",
+                dir=self.cache_dir,
+                prefix=f"{path.stem}-",
+                suffix=".tmp",
+                delete=False,
+            ) as f:
+                tmp_path = Path(f.name)
+                json.dump(feature_collection, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if tmp_path is not None:
+                tmp_path.unlink(missing_ok=True)
+            warnings.warn(
+                f"Error writing map cache {path.name}: {e}",
+                RuntimeWarning,
+                stacklevel=2,
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pré-calcula os contornos simplificados dos mapas das UFs"
+    )
+    parser.add_argument("ufs", nargs="*", help="UFs, por padrão todas com shapefile")
+    args = parser.parse_args()
+
+    map_layers = MapLayerCache()
+    for state in args.ufs or map_layers.available_states():
+        map_layers.precompute(state)
+        print(f"{state}: {', '.join(f'{t:g}' for t in map_layers.tolerances)}")
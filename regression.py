@@ -0,0 +1,518 @@
+import argparse
+import importlib
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmark import make_scenario_terms, make_terms
+from calculations import TERM_KEYS, OnusCalculator
+from data_processor import ROOT, DataProcessor, iter_term_chunks
+
+GOLDEN_DIR = ROOT / "data/golden"
+# Largest difference accepted from the frozen figures: relative to the
+# figure, or absolute for values near zero (factors and R$)
+GOLDEN_RTOL = 1e-9
+GOLDEN_ATOL = 1e-9
+GOLDEN_ROL = 1_000_000.0
+FACTOR_COLUMNS = ["fatorFreq", "fatorPop", "onusMunicipio"]
+# Term sets of the golden corpus. The legacy DataProcessor.calculate_onus
+# loops over municipalities, so it only runs on terms up to
+# LEGACY_MAX_MUNICIPALITIES
+GOLDEN_CORPUS = {
+    "carteira": lambda data_processor: make_portfolio(data_processor, 30, seed=0),
+    "setores": lambda data_processor: make_scenario_terms(
+        data_processor, 3, 3, "setores", 3, seed=1
+    ),
+    "toda_uf": lambda data_processor: make_scenario_terms(
+        data_processor, 2, 3, "toda_uf", 5, states=("MG", "SP", "AC"), seed=2
+    ),
+}
+LEGACY_MAX_MUNICIPALITIES = 150
+# States whose terms check_golden calculates by default: small ones, with AP
+# missing population in 2023 and AC covered whole. The repeated municipalities
+# of AM are still checked by check_pop_total_semantics, and the larger states
+# only with --completo
+GOLDEN_QUICK_STATES = ("AC", "AP", "DF")
+# Modules loaded from the checkout given to freeze_golden as the reference
+REFERENCE_MODULES = ["data_processor", "calculations"]
+
+
+def make_portfolio(data_processor, n_terms, years=(2022, 2023), seed=0):
+    """
+    Synthetic terms over several years, including states with quirks in the
+    reference data: AM has municipalities repeated with different popUF in 2023
+    and AP has no population in 2023
+
+    Returns:
+        DataFrame: Terms in the schema of the uploaded CSVs
+    """
+    return pd.concat(
+        [
+            make_terms(
+                data_processor,
+                n_terms,
+                year=year,
+                states=("MG", "AM", "DF", "AP"),
+                seed=seed + i,
+            )
+            for i, year in enumerate(years)
+        ],
+        ignore_index=True,
+    )
+
+
+def check_pop_total_semantics(data_processor, n_terms=40, seed=0):
+    """
+    Check the two population totals of OnusCalculator.calculate_onus, which
+    deliberately differ:
+
+    - fatorPop divides popMun by the population of every distinct (Municipio,
+      popMun) pair in the base-year rows of all terms, of any entity and state
+    - the returned pop_total sums popMun over the term's own municipalities,
+      once per codMun, and is NaN when none of them has population data
+
+    Also checks that the expanded rows carry coefPop = popMun / popUF.
+
+    Returns:
+        list: Description of each failed check
+    """
+    calculator = OnusCalculator(data_processor)
+    df_data = data_processor.gerar_tabela_final(
+        make_portfolio(data_processor, n_terms, seed=seed)
+    )
+    failures = []
+
+    coef_pop = (df_data["popMun"] / df_data["popUF"]).astype(float)
+    if not np.allclose(df_data["coefPop"].astype(float), coef_pop, equal_nan=True):
+        failures.append("coefPop != popMun / popUF")
+
+    df_unique = df_data.drop_duplicates()
+    for key in df_unique[TERM_KEYS].drop_duplicates().itertuples(index=False):
+        _, df_factors, pop_total = calculator.calculate_onus(
+            key.AnoBase, key.Entidade, key.UF, key.NumTermo, key.AnoTermo, 1e6, df_data
+        )
+        df_year = df_unique[df_unique["AnoBase"] == key.AnoBase]
+
+        denominator = df_year[["Municipio", "popMun"]].drop_duplicates()["popMun"].sum()
+        pop_mun = df_factors["codMun"].map(
+            df_year.drop_duplicates("codMun").set_index("codMun")["popMun"]
+        )
+        if not np.allclose(
+            df_factors["fatorPop"].astype(float),
+            (pop_mun / denominator).astype(float),
+            equal_nan=True,
+        ):
+            failures.append(f"fatorPop of {tuple(key)}")
+
+        is_term_mun = df_year["codMun"].isin(df_factors["codMun"])
+        expected_total = (
+            df_year.loc[is_term_mun, ["codMun", "popMun"]]
+            .drop_duplicates()["popMun"]
+            .sum(min_count=1)
+        )
+        if not np.allclose(
+            _number(pop_total), _number(expected_total), rtol=0, equal_nan=True
+        ):
+            failures.append(
+                f"pop_total of {tuple(key)}: {pop_total} != {expected_total}"
+            )
+
+    return failures
+
+
+def check_missing_population(data_processor, calculator=None):
+    """
+    Check that the terms of the golden portfolio none of whose municipalities
+    has population data (AP in 2023) get an undefined ônus instead of R$ 0,00:
+    NaN total_onus, pop_total, fatorPop and onusMunicipio from calculate_onus,
+    and NaN onusTermo and popTotal from calculate_all_onus
+
+    Returns:
+        list: Description of each failed check
+    """
+    calculator = calculator or OnusCalculator(data_processor)
+    df_terms = pd.concat(iter_term_chunks(_golden_path("carteira", "termos")))
+    df_data = data_processor.gerar_tabela_final(df_terms)
+    without_population = _terms_without_population(df_data)
+    if not without_population:
+        return ["Nenhum termo sem população no corpus carteira"]
+
+    failures = []
+    for key in without_population:
+        total_onus, df_factors, pop_total = calculator.calculate_onus(
+            *key, GOLDEN_ROL, df_data
+        )
+        if not np.isnan(_number(total_onus)):
+            failures.append(f"total_onus de {key} sem população: {total_onus}")
+        if not np.isnan(_number(pop_total)):
+            failures.append(f"pop_total de {key} sem população: {pop_total}")
+        if df_factors[["fatorPop", "onusMunicipio"]].notna().any(axis=None):
+            failures.append(f"fatores de {key} sem população definidos")
+
+    df_all_terms, _ = calculator.calculate_all_onus(
+        df_data, {key: GOLDEN_ROL for key in zip(df_terms["Entidade"], df_terms["UF"])}
+    )
+    df_all_terms = df_all_terms.set_index(TERM_KEYS).loc[without_population]
+    for key, onus, population in df_all_terms[["onusTermo", "popTotal"]].itertuples():
+        if not (np.isnan(_number(onus)) and np.isnan(_number(population))):
+            failures.append(
+                f"calculate_all_onus de {key} sem população: {onus}, {population}"
+            )
+    return failures
+
+
+def _term_keys(df_data, states=None):
+    """Distinct terms of an expanded table, optionally only of some states"""
+    df_keys = df_data[TERM_KEYS].drop_duplicates()
+    if states is not None:
+        df_keys = df_keys[df_keys["UF"].isin(states)]
+    return list(df_keys.itertuples(index=False))
+
+
+def _in_states(df, states):
+    """Rows of a golden table in the given states, or all of them if None"""
+    return df if states is None else df[df["UF"].isin(states)]
+
+
+def golden_outputs(data_processor, df_terms, calculator=None, states=None):
+    """
+    Ônus of every term of a term set, per term and per municipality
+
+    Args:
+        data_processor: DataProcessor with the reference data
+        df_terms: Terms as strings, in the schema of the uploaded CSVs
+        calculator: Object with the calculate_onus of OnusCalculator. Defaults
+            to a new OnusCalculator
+        states: Only calculate the terms of these states, still against the
+            whole term set that the population totals span. Defaults to all
+
+    Returns:
+        tuple: (terms_dataframe with total_onus, pop_total and numMunicipios,
+            factors_dataframe with the FACTOR_COLUMNS of each municipality),
+            both keyed by TERM_KEYS
+    """
+    calculator = calculator or OnusCalculator(data_processor)
+    df_data = data_processor.gerar_tabela_final(df_terms)
+    terms, factors = [], []
+    for key in _term_keys(df_data, states):
+        total_onus, df_factors, pop_total = calculator.calculate_onus(
+            *key, GOLDEN_ROL, df_data
+        )
+        terms.append(
+            (*key, _number(total_onus), _number(pop_total), len(df_factors))
+        )
+        factors.append(
+            df_factors[["codMun"] + FACTOR_COLUMNS].assign(**key._asdict())
+        )
+    return _golden_frames(terms, factors)
+
+
+def legacy_golden_outputs(data_processor, df_terms, states=None):
+    """
+    Same as golden_outputs, from the legacy DataProcessor.calculate_onus, for
+    the terms up to LEGACY_MAX_MUNICIPALITIES
+
+    The legacy method needs numeric Banda and FrequenciaCentral and drops the
+    duplicates of df_data in place, so it gets its own numeric copy.
+    """
+    df_data = data_processor.gerar_tabela_final(df_terms).astype(
+        {"Banda": "float", "FrequenciaCentral": "float"}
+    )
+    sizes = (
+        df_data.drop_duplicates(TERM_KEYS + ["codMun"])
+        .groupby(TERM_KEYS, sort=False, observed=True)
+        .size()
+    )
+    terms, factors = [], []
+    for key in _term_keys(df_data, states):
+        if sizes[tuple(key)] > LEGACY_MAX_MUNICIPALITIES:
+            continue
+        total_onus, df_factors, pop_total = data_processor.calculate_onus(
+            *key, GOLDEN_ROL, df_data
+        )
+        terms.append(
+            (*key, _number(total_onus), _number(pop_total), len(df_factors))
+        )
+        factors.append(
+            df_factors[["codMun"] + FACTOR_COLUMNS]
+            .astype({col: "float" for col in FACTOR_COLUMNS})
+            .assign(**key._asdict())
+        )
+    return _golden_frames(terms, factors)
+
+
+def _number(value):
+    """
+    Scalar, or one-element array as returned by older implementations, as a
+    float, with missing values (e.g. AP in 2023) as NaN
+    """
+    if not pd.api.types.is_scalar(value):
+        (value,) = pd.array(value)
+    return np.nan if pd.isna(value) else float(value)
+
+
+def _golden_frames(terms, factors):
+    """Terms and factors frames of golden_outputs"""
+    df_terms = pd.DataFrame(
+        terms, columns=TERM_KEYS + ["total_onus", "pop_total", "numMunicipios"]
+    )
+    factor_columns = TERM_KEYS + ["codMun"] + FACTOR_COLUMNS
+    # No factors when states leaves none of the terms of a term set
+    df_factors = (
+        pd.concat(factors, ignore_index=True)[factor_columns]
+        if factors
+        else pd.DataFrame(columns=factor_columns)
+    )
+    return df_terms, df_factors.astype({"codMun": "int64"})
+
+
+def _golden_path(name, table):
+    """File of a table of the golden corpus"""
+    return GOLDEN_DIR / f"{name}-{table}.csv.gz"
+
+
+def _read_golden(name, table):
+    """Table of the golden corpus, with the term keys as strings"""
+    return pd.read_csv(
+        _golden_path(name, table), dtype={col: "string" for col in TERM_KEYS}
+    )
+
+
+def load_reference(path):
+    """
+    DataProcessor and OnusCalculator of another checkout of the repository,
+    e.g. of the commit before the current optimizations, to freeze the golden
+    corpus with. The checkout must hold the same reference data.
+
+    Args:
+        path: Directory of the checkout
+
+    Returns:
+        tuple: (DataProcessor, OnusCalculator) of the checkout
+    """
+    current = {name: sys.modules.pop(name, None) for name in REFERENCE_MODULES}
+    sys.path.insert(0, str(path))
+    try:
+        modules = {name: importlib.import_module(name) for name in REFERENCE_MODULES}
+    finally:
+        sys.path.remove(str(path))
+        for name, module in current.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    data_processor = modules["data_processor"].DataProcessor()
+    # Older checkouts read the populations as strings, which pandas 2 does not
+    # sum
+    data_processor.df_pop = data_processor.df_pop.astype(
+        {"popMun": "Int64", "popUF": "Int64"}
+    )
+    return data_processor, modules["calculations"].OnusCalculator(data_processor)
+
+
+def _terms_without_population(df_data):
+    """Terms none of whose municipalities has population data"""
+    has_population = df_data["popMun"].notna().groupby(
+        [df_data[col] for col in TERM_KEYS], sort=False, observed=True
+    ).any()
+    return [tuple(key) for key in has_population.index[~has_population]]
+
+
+def freeze_golden(data_processor, reference=None):
+    """
+    Build the term sets of GOLDEN_CORPUS and save them in GOLDEN_DIR, with the
+    figures of the implementations of reference as the expected outputs
+
+    The pop_total of calculate_onus for the terms without population data is
+    frozen as NaN, which OnusCalculator.calculate_onus used to report as 0.
+    The legacy pop_total, the population of the whole base year, is kept.
+
+    Args:
+        data_processor: DataProcessor building the term sets, whose data
+            fingerprint is recorded
+        reference: (DataProcessor, OnusCalculator) whose figures are frozen,
+            e.g. from load_reference. Defaults to the current implementations
+    """
+    reference_processor, reference_calculator = reference or (
+        data_processor,
+        OnusCalculator(data_processor),
+    )
+    GOLDEN_DIR.mkdir(parents=True, exist_ok=True)
+    for name, build in GOLDEN_CORPUS.items():
+        df_terms = build(data_processor)
+        df_terms.to_csv(_golden_path(name, "termos"), index=False)
+        without_population = _terms_without_population(
+            data_processor.gerar_tabela_final(df_terms)
+        )
+        outputs = {
+            "onus": golden_outputs(
+                reference_processor, df_terms, reference_calculator
+            ),
+            "legado": legacy_golden_outputs(reference_processor, df_terms),
+        }
+        df_onus = outputs["onus"][0]
+        is_missing = pd.MultiIndex.from_frame(df_onus[TERM_KEYS]).isin(
+            without_population
+        )
+        df_onus.loc[is_missing, "pop_total"] = np.nan
+        for prefix, (df_onus, df_factors) in outputs.items():
+            df_onus.to_csv(_golden_path(name, prefix), index=False)
+            df_factors.to_csv(_golden_path(name, f"{prefix}-fatores"), index=False)
+        print(f"{name}: {len(df_terms)} termos")
+
+    (GOLDEN_DIR / "manifest.json").write_text(
+        json.dumps(
+            {
+                "dados": data_processor.data_fingerprint,
+                "rol": GOLDEN_ROL,
+                "rtol": GOLDEN_RTOL,
+                "atol": GOLDEN_ATOL,
+                "conjuntos": list(GOLDEN_CORPUS),
+            },
+            indent=2,
+        )
+    )
+
+
+def _compare(label, df_expected, df_actual, keys, columns):
+    """Failures of df_actual against df_expected, matched on keys"""
+    df_actual = df_actual.astype({col: "string" for col in TERM_KEYS})
+    df = df_expected.merge(
+        df_actual, how="outer", on=keys, suffixes=("", "_atual"), indicator=True
+    )
+    df_unmatched = df.loc[df["_merge"] != "both", keys + ["_merge"]]
+    failures = [
+        f"{label}: {tuple(key)} {'ausente' if side == 'left_only' else 'inesperado'}"
+        for *key, side in df_unmatched.itertuples(index=False)
+    ]
+    df = df[df["_merge"] == "both"]
+    for col in columns:
+        expected = df[col].to_numpy(dtype=float)
+        actual = df[f"{col}_atual"].to_numpy(dtype=float)
+        wrong = ~np.isclose(
+            actual, expected, rtol=GOLDEN_RTOL, atol=GOLDEN_ATOL, equal_nan=True
+        )
+        failures += [
+            f"{label}: {col} de {tuple(key)}: {got} != {want}"
+            for key, got, want in zip(
+                df.loc[wrong, keys].itertuples(index=False),
+                actual[wrong],
+                expected[wrong],
+            )
+        ]
+    return failures
+
+
+def check_golden(data_processor, calculator=None, states=GOLDEN_QUICK_STATES):
+    """
+    Compare the current implementations with the frozen golden corpus
+
+    Checked for every term set of GOLDEN_CORPUS, to GOLDEN_RTOL/GOLDEN_ATOL:
+    total_onus, pop_total and the factors of calculate_onus (of calculator,
+    e.g. a faster engine with the same interface), the same figures of the
+    legacy DataProcessor.calculate_onus, and the ônus and factors of
+    OnusCalculator.calculate_all_onus against those of calculate_onus.
+
+    The per-term figures, whose legacy implementation is slow, are only
+    calculated for the terms of states, or for all of them if it is None.
+    calculate_all_onus is always checked on every term.
+
+    Returns:
+        list: Description of each failed check
+    """
+    manifest = json.loads((GOLDEN_DIR / "manifest.json").read_text())
+    if manifest["dados"] != data_processor.data_fingerprint:
+        return ["Dados de referência diferentes dos usados no corpus (--congelar)"]
+
+    calculator = calculator or OnusCalculator(data_processor)
+    mun_keys = TERM_KEYS + ["codMun"]
+    failures = []
+    for name in manifest["conjuntos"]:
+        df_terms = pd.concat(iter_term_chunks(_golden_path(name, "termos")))
+        df_expected = _read_golden(name, "onus")
+        df_expected_factors = _read_golden(name, "onus-fatores")
+        actual = {
+            "onus": golden_outputs(data_processor, df_terms, calculator, states),
+            "legado": legacy_golden_outputs(data_processor, df_terms, states),
+        }
+        for prefix, (df_onus, df_factors) in actual.items():
+            failures += _compare(
+                f"{name}/{prefix}",
+                _in_states(_read_golden(name, prefix), states),
+                df_onus,
+                TERM_KEYS,
+                ["total_onus", "pop_total", "numMunicipios"],
+            )
+            failures += _compare(
+                f"{name}/{prefix}-fatores",
+                _in_states(_read_golden(name, f"{prefix}-fatores"), states),
+                df_factors,
+                mun_keys,
+                FACTOR_COLUMNS,
+            )
+
+        df_all_terms, df_all_factors = calculator.calculate_all_onus(
+            data_processor.gerar_tabela_final(df_terms),
+            {key: GOLDEN_ROL for key in zip(df_terms["Entidade"], df_terms["UF"])},
+        )
+        failures += _compare(
+            f"{name}/todos",
+            df_expected,
+            df_all_terms.rename(columns={"onusTermo": "total_onus"}),
+            TERM_KEYS,
+            ["total_onus", "numMunicipios"],
+        )
+        failures += _compare(
+            f"{name}/todos-fatores",
+            df_expected_factors,
+            df_all_factors.drop_duplicates(mun_keys),
+            mun_keys,
+            FACTOR_COLUMNS,
+        )
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Testes de regressão do cálculo do ônus"
+    )
+    parser.add_argument("--termos", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--congelar",
+        action="store_true",
+        help="Regrava o corpus de referência com os resultados atuais ou os de "
+        "--referencia",
+    )
+    parser.add_argument(
+        "--referencia",
+        type=Path,
+        help="Com --congelar, usa os resultados do código deste diretório "
+        "(p.ex. um checkout do commit anterior às otimizações)",
+    )
+    parser.add_argument(
+        "--completo",
+        action="store_true",
+        help="Calcula termo a termo todo o corpus de referência, não só os "
+        f"termos de {', '.join(GOLDEN_QUICK_STATES)} (mais lento)",
+    )
+    args = parser.parse_args()
+
+    data_processor = DataProcessor()
+    if args.congelar:
+        freeze_golden(
+            data_processor, args.referencia and load_reference(args.referencia)
+        )
+    failures = check_pop_total_semantics(data_processor, args.termos, args.seed)
+    failures += check_missing_population(data_processor)
+    failures += check_golden(
+        data_processor, states=None if args.completo else GOLDEN_QUICK_STATES
+    )
+    for failure in failures:
+        print(f"FALHA: {failure}")
+    print("OK" if not failures else f"{len(failures)} falhas")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,288 @@
+import mmap
+import struct
+from pathlib import Path
+
+import numpy as np
+
+# Shape types with polygon records; the Z and M variants append arrays that
+# are not read
+POLYGON_TYPES = {5, 15, 25}
+NULL_SHAPE = 0
+SHP_HEADER_BYTES = 100
+DBF_DEFAULT_ENCODING = "latin-1"
+# Douglas-Peucker spans up to this many points are scanned without numpy
+_SMALL_SEGMENT = 64
+
+
+def read_dbf(path, encoding=None):
+    """
+    Read the records of a dBase III table, such as the .dbf of a shapefile
+
+    Character fields are stripped and numeric fields become int or float (None
+    if blank). Deleted records are kept, so record i matches shape i of the
+    shapefile.
+
+    Args:
+        path: Path of the .dbf file
+        encoding: Text encoding. Defaults to the one in the .cpg file next to
+            it, or latin-1
+
+    Returns:
+        list: One dict per record, keyed by field name
+    """
+    path = Path(path)
+    if encoding is None:
+        cpg_path = path.with_suffix(".cpg")
+        encoding = (
+            cpg_path.read_text().strip() if cpg_path.exists() else DBF_DEFAULT_ENCODING
+        )
+
+    data = path.read_bytes()
+    n_records, header_length, record_length = struct.unpack("<IHH", data[4:12])
+    fields = []
+    offset = 1  # Deletion flag
+    for position in range(32, header_length - 1, 32):
+        if data[position] == 0x0D:
+            break
+        name = data[position : position + 11].split(b"\0")[0].decode("ascii")
+        field_type = chr(data[position + 11])
+        length, decimals = data[position + 16], data[position + 17]
+        fields.append((name, field_type, offset, length, decimals))
+        offset += length
+
+    records = []
+    data_end = header_length + n_records * record_length
+    for start in range(header_length, data_end, record_length):
+        record = {}
+        for name, field_type, offset, length, decimals in fields:
+            raw = data[start + offset : start + offset + length]
+            if field_type in "NF":
+                text = raw.strip().decode("ascii")
+                if not text or text.startswith("*"):
+                    record[name] = None
+                else:
+                    record[name] = int(text) if decimals == 0 else float(text)
+            else:
+                record[name] = raw.decode(encoding, errors="replace").strip()
+        records.append(record)
+    return records
+
+
+def simplify_line(coords, tolerance):
+    """
+    Douglas-Peucker simplification of a line
+
+    Args:
+        coords: Array of shape (n, 2). A closed ring keeps its first point
+        tolerance: Largest distance between the line and a removed point
+
+    Returns:
+        ndarray: The points kept, in order
+    """
+    n = len(coords)
+    if n < 3 or tolerance <= 0:
+        return coords
+    xs, ys = coords[:, 0].tolist(), coords[:, 1].tolist()
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x0, y0 = xs[first], ys[first]
+        dx, dy = xs[last] - x0, ys[last] - y0
+        norm = (dx * dx + dy * dy) ** 0.5
+        if last - first > _SMALL_SEGMENT:
+            points = coords[first + 1 : last] - (x0, y0)
+            if norm == 0:
+                # Closed ring, measure the distance to the shared endpoint
+                distances = np.hypot(points[:, 0], points[:, 1])
+            else:
+                distances = np.abs(points[:, 0] * dy - points[:, 1] * dx) / norm
+            farthest = int(distances.argmax())
+            max_distance = distances[farthest]
+            middle = first + 1 + farthest
+        else:
+            # Scanned in Python, cheaper than numpy calls on a few points
+            max_distance, middle = -1.0, first
+            for i in range(first + 1, last):
+                px, py = xs[i] - x0, ys[i] - y0
+                if norm == 0:
+                    distance = (px * px + py * py) ** 0.5
+                else:
+                    distance = abs(px * dy - py * dx) / norm
+                if distance > max_distance:
+                    max_distance, middle = distance, i
+        if max_distance > tolerance:
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return coords[keep]
+
+
+def _signed_area(ring):
+    """Twice the signed area of a ring, negative when clockwise"""
+    x, y = ring[:, 0], ring[:, 1]
+    return float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def _contains(ring, point):
+    """Whether a point lies inside a ring, by the even-odd rule"""
+    x, y = ring[:, 0], ring[:, 1]
+    x0, y0, x1, y1 = x[:-1], y[:-1], x[1:], y[1:]
+    crosses = (y0 > point[1]) != (y1 > point[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = x0 + (point[1] - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crosses & (point[0] < x_cross)) % 2)
+
+
+def _polygons(rings):
+    """
+    Group the rings of a record into polygons: shapefile outer rings are
+    clockwise, and each counterclockwise ring is a hole of the outer ring
+    containing it
+    """
+    polygons = []
+    holes = []
+    for ring in rings:
+        (polygons if _signed_area(ring) <= 0 else holes).append([ring])
+    if not polygons:
+        # Rings in the wrong orientation, read all as outer rings
+        return holes
+    for (hole,) in holes:
+        polygon = next(
+            (p for p in polygons if _contains(p[0], hole[0])), polygons[-1]
+        )
+        polygon.append(hole)
+    return polygons
+
+
+class ShapefileReader:
+    """
+    Reader of the polygon records of a shapefile
+
+    The .shp is memory-mapped and each record is located through the offsets
+    in the .shx, so reading some records never touches the others. Geometries
+    come out as GeoJSON dicts, optionally simplified.
+    """
+
+    def __init__(self, path, encoding=None):
+        """
+        Open a shapefile
+
+        Args:
+            path: Path of the .shp file; the .shx and .dbf must be next to it
+            encoding: Encoding of the .dbf, see read_dbf
+        """
+        self.path = Path(path)
+        with open(self.path.with_suffix(".shx"), "rb") as f:
+            shx = f.read()
+        self.offsets = (
+            np.frombuffer(shx, dtype=">i4", offset=SHP_HEADER_BYTES)[::2].astype(
+                np.int64
+            )
+            * 2
+        )
+        self.bbox = list(struct.unpack("<4d", shx[36:68]))
+        self.records = read_dbf(self.path.with_suffix(".dbf"), encoding)
+
+        self._file = open(self.path, "rb")
+        self._shp = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the memory map and the file"""
+        self._shp.close()
+        self._file.close()
+
+    def index(self, field):
+        """Mapping of the values of a DBF field to their record numbers"""
+        return {record[field]: i for i, record in enumerate(self.records)}
+
+    def geometry(self, i, tolerance=0):
+        """
+        GeoJSON geometry of a record
+
+        Rings simplified to less than four points are dropped. If that drops
+        every polygon, the record keeps its original rings.
+
+        Args:
+            i: Record number
+            tolerance: Douglas-Peucker tolerance, 0 to keep every point
+
+        Returns:
+            dict: Polygon or MultiPolygon geometry, or None for a null shape
+        """
+        start = int(self.offsets[i]) + 8
+        shape_type = struct.unpack_from("<i", self._shp, start)[0]
+        if shape_type == NULL_SHAPE:
+            return None
+        if shape_type not in POLYGON_TYPES:
+            raise ValueError(f"Tipo de geometria não suportado: {shape_type}")
+
+        n_parts, n_points = struct.unpack_from("<2i", self._shp, start + 36)
+        parts = np.frombuffer(
+            self._shp, dtype="<i4", count=n_parts, offset=start + 44
+        ).tolist()
+        points = np.frombuffer(
+            self._shp,
+            dtype="<f8",
+            count=2 * n_points,
+            offset=start + 44 + 4 * n_parts,
+        ).reshape(-1, 2)
+        rings = [
+            points[first:last] for first, last in zip(parts, parts[1:] + [n_points])
+        ]
+
+        polygons = _polygons(rings)
+        coordinates = []
+        for polygon in polygons:
+            simplified = [simplify_line(ring, tolerance) for ring in polygon]
+            if len(simplified[0]) >= 4:
+                coordinates.append(
+                    [ring.tolist() for ring in simplified if len(ring) >= 4]
+                )
+        if not coordinates:
+            # Every outer ring collapsed, keep the original outlines
+            coordinates = [[ring.tolist() for ring in polygon] for polygon in polygons]
+
+        if len(coordinates) == 1:
+            return {"type": "Polygon", "coordinates": coordinates[0]}
+        return {"type": "MultiPolygon", "coordinates": coordinates}
+
+    def features(self, rows=None, tolerance=0, properties=None):
+        """
+        GeoJSON features of some records
+
+        Args:
+            rows: Record numbers to read. Defaults to all
+            tolerance: Douglas-Peucker tolerance of the geometries
+            properties: DBF fields kept as properties. Defaults to all
+
+        Returns:
+            list: One GeoJSON Feature per record
+        """
+        if rows is None:
+            rows = range(len(self))
+        features = []
+        for i in rows:
+            record = self.records[i]
+            if properties is not None:
+                record = {field: record[field] for field in properties}
+            features.append(
+                {
+                    "type": "Feature",
+                    "properties": record,
+                    "geometry": self.geometry(i, tolerance),
+                }
+            )
+        return features
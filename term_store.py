@@ -0,0 +1,519 @@
+import json
+import sqlite3
+import threading
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from data_processor import (
+    EXPECTED_COLUMNS,
+    AreaExpansionCache,
+    bandwidth_ratio,
+    term_row_hashes,
+)
+
+# Columns of the expanded rows taken from the reference data, the others come
+# from the term
+MUNICIPALITY_COLUMNS = [
+    "UF",
+    "codMun",
+    "AreaPrestacao",
+    "Municipio",
+    "popMun",
+    "AnoBase",
+    "popUF",
+    "coefPop",
+]
+EXPANDED_COLUMNS = MUNICIPALITY_COLUMNS + [
+    "AreaExclusao",
+    "MunicipioExclusao",
+    "Entidade",
+    "NumTermo",
+    "AnoTermo",
+    "FrequenciaInicial",
+    "FrequenciaFinal",
+    "FrequenciaCentral",
+    "Banda",
+    "Tipo",
+    "BW_Freq",
+]
+EXPANDED_DTYPES = {
+    "UF": "category",
+    "codMun": "Int32",
+    "AreaPrestacao": "category",
+    "Municipio": "category",
+    "popMun": "Int32",
+    "popUF": "Int64",
+    "coefPop": "Float64",
+    "BW_Freq": "float",
+}
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS termos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dono TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    expandido INTEGER NOT NULL DEFAULT 0,
+    {", ".join(f"{col} TEXT" for col in EXPECTED_COLUMNS)},
+    BW_Freq REAL,
+    UNIQUE (dono, hash)
+);
+CREATE INDEX IF NOT EXISTS termos_chave
+    ON termos (dono, Entidade, UF, NumTermo, AnoTermo);
+CREATE TABLE IF NOT EXISTS municipios (
+    termo INTEGER NOT NULL REFERENCES termos (id) ON DELETE CASCADE,
+    UF TEXT,
+    codMun INTEGER,
+    AreaPrestacao TEXT,
+    Municipio TEXT,
+    popMun INTEGER,
+    AnoBase TEXT,
+    popUF INTEGER,
+    coefPop REAL
+);
+CREATE INDEX IF NOT EXISTS municipios_populacao ON municipios (AnoBase, UF, codMun);
+CREATE INDEX IF NOT EXISTS municipios_termo ON municipios (termo);
+CREATE TABLE IF NOT EXISTS referencia (fingerprint TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS donos (
+    dono TEXT PRIMARY KEY,
+    fingerprint INTEGER NOT NULL DEFAULT 0
+);
+-- Running XOR of the hashes of each owner; SQLite has no XOR operator
+CREATE TRIGGER IF NOT EXISTS termos_inclusao AFTER INSERT ON termos BEGIN
+    INSERT OR IGNORE INTO donos (dono) VALUES (NEW.dono);
+    UPDATE donos SET fingerprint = (fingerprint | NEW.hash) & ~(fingerprint & NEW.hash)
+        WHERE dono = NEW.dono;
+END;
+CREATE TRIGGER IF NOT EXISTS termos_exclusao AFTER DELETE ON termos BEGIN
+    UPDATE donos SET fingerprint = (fingerprint | OLD.hash) & ~(fingerprint & OLD.hash)
+        WHERE dono = OLD.dono;
+END;
+"""
+
+
+def _filter(df, filters):
+    """Rows of df equal to every column=value in filters"""
+    return df[_mask(df, filters)] if filters else df
+
+
+def _mask(df, filters):
+    """Whether each row of df equals every column=value in filters"""
+    mask = np.ones(len(df), dtype=bool)
+    for col, value in filters.items():
+        mask &= (df[col] == value).fillna(False).to_numpy(dtype=bool)
+    return mask
+
+
+def _xor_hashes(row_hashes):
+    """Fingerprint of a set of rows: the XOR of their uint64 row hashes"""
+    return int(np.bitwise_xor.reduce(row_hashes, initial=0))
+
+
+class TermStore:
+    """
+    Registered terms of a session, indexed by the hash of each row
+
+    Rows are kept in a dict keyed by their term_row_hashes, which also keeps the
+    insertion order, so adding, finding and deleting a row are O(1) and never
+    copy the other rows. The DataFrame of all terms is only built when read
+    after a change. Every method can be called while another thread expands
+    the terms.
+    """
+
+    def __init__(self):
+        """Initialize an empty store"""
+        self._rows = {}
+        self._df = None
+        self._df_hashes = None
+        self._area_cache = AreaExpansionCache()
+        self._fingerprint = 0
+        self._lock = threading.RLock()
+        self._expand_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def empty(self):
+        """Whether no term is registered"""
+        return not self._rows
+
+    def add(self, df):
+        """
+        Register the rows of df that are not registered yet
+
+        Args:
+            df: DataFrame with the EXPECTED_COLUMNS
+
+        Returns:
+            tuple: (number of rows added, number of duplicates skipped)
+        """
+        df = df.loc[:, EXPECTED_COLUMNS].astype("string")
+        added = 0
+        with self._lock:
+            for row_hash, row in zip(
+                term_row_hashes(df), df.itertuples(index=False, name=None)
+            ):
+                if row_hash not in self._rows:
+                    self._rows[row_hash] = row
+                    self._fingerprint ^= int(row_hash)
+                    added += 1
+
+            if added:
+                self._df = None
+        return added, len(df) - added
+
+    def delete(self, positions):
+        """
+        Remove terms by their position in df
+
+        Args:
+            positions: Row positions, as reported by the data editor
+        """
+        with self._lock:
+            df_hashes = self._df_hashes if self._df is not None else self._refresh()
+            for position in positions:
+                if self._rows.pop(df_hashes[position], None) is not None:
+                    self._fingerprint ^= int(df_hashes[position])
+            self._df = None
+
+    def clear(self):
+        """Remove all terms"""
+        with self._lock:
+            self._rows.clear()
+            self._df = None
+            self._fingerprint = 0
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the set of registered terms: the XOR of their row hashes,
+        updated in O(1) by every change
+        """
+        return self._fingerprint
+
+    def _refresh(self):
+        """Rebuild df from the rows and return the hashes of its rows"""
+        self._df = pd.DataFrame.from_records(
+            list(self._rows.values()), columns=EXPECTED_COLUMNS
+        ).astype("string")
+        self._df_hashes = np.fromiter(self._rows, dtype="uint64", count=len(self._rows))
+        return self._df_hashes
+
+    @property
+    def df(self):
+        """All terms as strings, in the order they were added"""
+        with self._lock:
+            if self._df is None:
+                self._refresh()
+            return self._df
+
+    def select(self, **filters):
+        """Terms whose columns equal the given values, e.g. select(UF="MG")"""
+        return _filter(self.df, filters)
+
+    def expanded(self, data_processor, **filters):
+        """
+        Municipality rows of the terms, from DataProcessor.gerar_tabela_final
+
+        The expansion of unchanged areas is reused between calls. The result
+        must not be modified in place.
+
+        Args:
+            data_processor: DataProcessor with the reference data
+            **filters: Values the columns of the terms must have, as in
+                select, e.g. AnoBase="2023"
+
+        Returns:
+            DataFrame: One row per municipality of the selected terms
+        """
+        _, expand = self.snapshot(**filters)
+        return expand(data_processor)
+
+    def snapshot(self, **filters):
+        """
+        The registered terms as they are now, to be expanded later, e.g. in a
+        background job, whatever changes meanwhile
+
+        Args:
+            **filters: Values the columns of the terms must have, as in
+                select, e.g. AnoBase="2023"
+
+        Returns:
+            tuple: (fingerprint of the selected terms, function of a
+                DataProcessor returning their expanded rows, as expanded does)
+        """
+        with self._lock:
+            df_terms, row_hashes = self.df, self._df_hashes
+            fingerprint = self._fingerprint
+        if filters:
+            fingerprint = _xor_hashes(row_hashes[_mask(df_terms, filters)])
+        return fingerprint, partial(self._expand, df_terms, row_hashes, filters)
+
+    def _expand(self, df_terms, row_hashes, filters, data_processor):
+        """
+        Expanded rows of the terms of df_terms, whose rows have the given
+        hashes, equal to filters
+        """
+        # Every term is expanded, so the area cache follows the whole table
+        # whatever slice is read
+        with self._expand_lock:
+            df_final = data_processor.gerar_tabela_final(
+                df_terms, self._area_cache, row_hashes
+            )
+        return _filter(df_final, filters)
+
+
+class SQLiteTermStore:
+    """
+    TermStore kept in a SQLite database together with the municipality rows of
+    each term, so both survive restarts
+
+    Each store reads and changes only the terms of its owner, so several
+    sessions can share one file. Terms are unique by owner and row hash and
+    indexed by (Entidade, UF, NumTermo, AnoTermo). Expanded rows are indexed
+    by term and by (AnoBase, UF, codMun), and are computed once per term, or
+    again for every term when the reference data changes. Filtered reads
+    select the terms first and only load the rows of those. The connection is
+    guarded by a lock and terms are expanded outside it, so the store stays
+    usable while another thread expands them.
+    """
+
+    def __init__(self, path, owner=""):
+        """
+        Open (or create) the database
+
+        Args:
+            path: Path of the SQLite file
+            owner: Identifies whose terms the store holds, e.g. a session
+        """
+        self.owner = owner
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+        self._df_hashes = np.zeros(0, dtype="uint64")
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM termos WHERE dono = ?", (self.owner,)
+            ).fetchone()
+        return row[0]
+
+    @property
+    def empty(self):
+        """Whether no term is registered"""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM termos WHERE dono = ? LIMIT 1", (self.owner,)
+            ).fetchone()
+        return row is None
+
+    def add(self, df):
+        """
+        Register the rows of df that are not registered yet
+
+        Args:
+            df: DataFrame with the EXPECTED_COLUMNS
+
+        Returns:
+            tuple: (number of rows added, number of duplicates skipped)
+        """
+        df = df.loc[:, EXPECTED_COLUMNS].astype("string").astype(object)
+        df = df.where(df.notna(), None)
+        # SQLite integers are signed
+        row_hashes = term_row_hashes(df).view("int64").tolist()
+        ratios = bandwidth_ratio(df).tolist()
+        columns = ", ".join(["dono", "hash"] + EXPECTED_COLUMNS + ["BW_Freq"])
+        placeholders = ", ".join("?" * (len(EXPECTED_COLUMNS) + 3))
+        with self._lock, self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO termos ({columns}) VALUES ({placeholders})",
+                (
+                    (self.owner, row_hash) + row + (ratio,)
+                    for row_hash, row, ratio in zip(
+                        row_hashes, df.itertuples(index=False, name=None), ratios
+                    )
+                ),
+            )
+            added = self.connection.total_changes - before
+        return added, len(df) - added
+
+    def delete(self, positions):
+        """
+        Remove terms by their position in the last df read
+
+        Args:
+            positions: Row positions, as reported by the data editor
+        """
+        row_hashes = self._df_hashes.view("int64")
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM termos WHERE dono = ? AND hash = ?",
+                ((self.owner, int(row_hashes[position])) for position in positions),
+            )
+
+    def clear(self):
+        """Remove all terms of the owner"""
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM termos WHERE dono = ?", (self.owner,))
+
+    @property
+    def df(self):
+        """All terms as strings, in the order they were added"""
+        return self.select()
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the set of registered terms, as in TermStore.fingerprint:
+        the XOR of their row hashes, kept per owner by the triggers of termos
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT fingerprint FROM donos WHERE dono = ?", (self.owner,)
+            ).fetchone()
+        # Back from a signed SQLite integer to the unsigned hash
+        return row[0] % 2**64 if row is not None else 0
+
+    def select(self, **filters):
+        """Terms whose columns equal the given values, e.g. select(UF="MG")"""
+        where, params = self._where(filters)
+        with self._lock:
+            df = pd.read_sql(
+                f"SELECT hash, {', '.join(EXPECTED_COLUMNS)} FROM termos{where} "
+                "ORDER BY id",
+                self.connection,
+                params=params,
+            )
+        row_hashes = df.pop("hash").to_numpy(dtype="int64").view("uint64")
+        if not filters:
+            self._df_hashes = row_hashes
+        return df.astype("string")
+
+    def expanded(self, data_processor, **filters):
+        """
+        Municipality rows of the terms, as from DataProcessor.gerar_tabela_final
+
+        Terms added since the last call are expanded and stored first, and
+        only the rows of the selected terms are read.
+
+        Args:
+            data_processor: DataProcessor with the reference data
+            **filters: Values the columns of the terms must have, as in
+                select, e.g. AnoBase="2023"
+
+        Returns:
+            DataFrame: One row per municipality of the selected terms
+        """
+        _, expand = self.snapshot(**filters)
+        return expand(data_processor)
+
+    def snapshot(self, **filters):
+        """
+        The registered terms as they are now, to be expanded later, e.g. in a
+        background job, whatever changes meanwhile. Only the rows of these
+        terms are read then, and terms added meanwhile are expanded and stored
+        but left out.
+
+        Args:
+            **filters: Values the columns of the terms must have, as in
+                select, e.g. AnoBase="2023"
+
+        Returns:
+            tuple: (fingerprint of the selected terms, function of a
+                DataProcessor returning their expanded rows, as expanded does)
+        """
+        where, params = self._where(filters)
+        with self._lock:
+            terms = self.connection.execute(
+                f"SELECT id, hash FROM termos{where}", params
+            ).fetchall()
+            fingerprint = self.fingerprint
+        term_ids = [term_id for term_id, _ in terms]
+        if filters:
+            fingerprint = _xor_hashes(
+                np.array([row_hash for _, row_hash in terms], dtype="int64").view(
+                    "uint64"
+                )
+            )
+        return fingerprint, partial(self._expand_terms, term_ids)
+
+    def _expand_terms(self, term_ids, data_processor):
+        """Expanded rows of the terms with the given ids"""
+        self._expand_pending(data_processor)
+        columns = [
+            f"{'m' if col in MUNICIPALITY_COLUMNS else 't'}.{col}"
+            for col in EXPANDED_COLUMNS
+        ]
+        with self._lock:
+            df = pd.read_sql(
+                f"SELECT {', '.join(columns)} FROM municipios m "
+                "JOIN termos t ON t.id = m.termo "
+                "WHERE t.id IN (SELECT value FROM json_each(?)) "
+                "ORDER BY m.termo, m.rowid",
+                self.connection,
+                params=[json.dumps(term_ids)],
+            )
+        return df.astype(EXPANDED_DTYPES)
+
+    def _expand_pending(self, data_processor):
+        """Expand and store the terms without municipality rows"""
+        fingerprint = data_processor.data_fingerprint
+        with self._lock, self.connection:
+            stored = self.connection.execute(
+                "SELECT fingerprint FROM referencia"
+            ).fetchone()
+            if stored is None or stored[0] != fingerprint:
+                # Rows derived from other reference data are stale
+                self.connection.execute("DELETE FROM municipios")
+                self.connection.execute("UPDATE termos SET expandido = 0")
+                self.connection.execute("DELETE FROM referencia")
+                self.connection.execute(
+                    "INSERT INTO referencia VALUES (?)", (fingerprint,)
+                )
+
+            df_pending = pd.read_sql(
+                f"SELECT id, {', '.join(EXPECTED_COLUMNS)} FROM termos "
+                "WHERE dono = ? AND expandido = 0 ORDER BY id",
+                self.connection,
+                params=[self.owner],
+            )
+        if df_pending.empty:
+            return
+
+        term_ids = df_pending.pop("id").to_numpy()
+        df_rows, term_rows = data_processor.expand_terms(df_pending.astype("string"))
+        df_rows = df_rows[MUNICIPALITY_COLUMNS].assign(termo=term_ids[term_rows])
+        with self._lock, self.connection:
+            # Terms deleted or expanded by another thread meanwhile are skipped
+            pending_ids = [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT id FROM termos WHERE dono = ? AND expandido = 0",
+                    (self.owner,),
+                )
+            ]
+            df_rows[df_rows["termo"].isin(pending_ids)].to_sql(
+                "municipios", self.connection, if_exists="append", index=False
+            )
+            self.connection.executemany(
+                "UPDATE termos SET expandido = 1 WHERE id = ?",
+                ((int(term_id),) for term_id in np.intersect1d(term_ids, pending_ids)),
+            )
+
+    def _where(self, filters):
+        """
+        SQL WHERE clause and parameters selecting the owner's terms and the
+        column=value filters
+        """
+        if unknown := [col for col in filters if col not in EXPECTED_COLUMNS]:
+            raise ValueError(f"Colunas não filtráveis: {', '.join(unknown)}")
+        clause = " AND ".join(["dono = ?"] + [f"{col} = ?" for col in filters])
+        return f" WHERE {clause}", [self.owner] + [
+            value.item() if hasattr(value, "item") else value
+            for value in filters.values()
+        ]
@@ -1,8 +1,9 @@
+import pandas as pd
+import pydeck as pdk
 import streamlit as st
 
-# import folium
-# from streamlit_folium import st_folium
 from datetime import datetime as dt
+from map_layers import DEFAULT_TOLERANCE
 
 
 class UIComponents:
@@ -283,99 +284,132 @@ class UIComponents:
             )
             return None, None, None, None, None
 
-    # @staticmethod
-    # def render_map(state, mun_codes):
-    #     """
-    #     Render the map for a specific state and municipalities
-
-    #     Args:
-    #         state: State code (UF)
-    #         mun_codes: List of municipality codes to highlight
-
-    #     Returns:
-    #         None
-    #     """
-    #     import geopandas as gpd
-
-    #     try:
-    #         # Load map data
-    #         map_data = gpd.read_file(Path(__file__).parent / f"SHP_UFs/{state}.shp")
-
-    #         if map_data is not None:
-    #             # Create GeoDataFrame
-    #             geo_df = gpd.GeoDataFrame(
-    #                 map_data, geometry="geometry", crs="EPSG:3857"
-    #             )
-
-    #             # Filter for selected municipalities
-    #             geo_df_area = geo_df[geo_df["geocodigo"].isin(mun_codes)]
-
-    #             # Get map bounds
-    #             lon_min, lat_min, lon_max, lat_max = map_data.total_bounds
-
-    #             # Create Folium map
-    #             map_folium = folium.Map(
-    #                 location=[-15.8, -47.8],
-    #                 no_touch=True,
-    #                 tiles="openstreetmap",
-    #                 control_scale=True,
-    #                 crs="EPSG3857",
-    #                 zoom_start=4,
-    #                 key="mapaBase",
-    #                 prefer_canvas=False,
-    #                 max_bounds=True,
-    #                 tooltip="tooltip",
-    #             )
-    #             map_folium.fit_bounds([[lat_min, lon_min], [lat_max, lon_max]])
-
-    #             # Add feature groups
-    #             group_map = folium.FeatureGroup(name="grupoMapa").add_to(map_folium)
-
-    #             # Add state boundaries
-    #             pol_sim_geo = gpd.GeoDataFrame(geo_df["geometry"]).simplify(
-    #                 tolerance=0.01
-    #             )
-    #             pol_geo_json = pol_sim_geo.to_json()
-    #             pol_geo = folium.GeoJson(
-    #                 data=pol_geo_json,
-    #                 style_function=lambda x: {
-    #                     "fillColor": "#FF0000",
-    #                     "fillOpacity": 0.2,
-    #                     "weight": 0.2,
-    #                     "color": "#B00000",
-    #                 },
-    #             )
-
-    #             # Add service area
-    #             pol_sim_geo_term = gpd.GeoDataFrame(geo_df_area["geometry"]).simplify(
-    #                 tolerance=0.01
-    #             )
-    #             pol_geo_json_term = pol_sim_geo_term.to_json()
-    #             pol_geo_term = folium.GeoJson(
-    #                 data=pol_geo_json_term,
-    #                 style_function=lambda x: {
-    #                     "fillColor": "#4AC423",
-    #                     "color": "#1C5727",
-    #                     "fillOpacity": 0.5,
-    #                     "weight": 0.5,
-    #                 },
-    #             )
-
-    #             # Add layers to map
-    #             group_map.add_child(pol_geo_term)
-    #             group_map.add_child(pol_geo)
-
-    #             # Display the map
-    #             st_folium(
-    #                 map_folium,
-    #                 feature_group_to_add=group_map,
-    #                 returned_objects=[],
-    #                 zoom=4,
-    #                 width=1200,
-    #                 height=600,
-    #             )
-    #     except Exception as e:
-    #         st.error(f"Erro ao carregar o mapa: {e}")
+    @staticmethod
+    def render_map(map_layers, state, mun_codes):
+        """
+        Render the map for a specific state and municipalities
+
+        Args:
+            map_layers: MapLayerCache with the outlines of the states
+            state: State code (UF)
+            mun_codes: List of municipality codes to highlight
+
+        Returns:
+            None
+        """
+        tolerance = st.select_slider(
+            "Simplificação dos contornos (graus)",
+            options=map_layers.tolerances,
+            value=DEFAULT_TOLERANCE,
+            key="inp_toleranciaMapa",
+        )
+        layer = map_layers.layer(state, tolerance)
+        if layer is None:
+            st.warning(f"Mapa indisponível para a UF {state}.", icon="⚠️")
+            return
+
+        try:
+            lon_min, lat_min, lon_max, lat_max = layer.bounds
+            view_state = pdk.data_utils.compute_view(
+                [[lon_min, lat_min], [lon_max, lat_max]], view_proportion=1
+            )
+
+            # State boundaries and service area, drawn with pydeck, which
+            # ships with Streamlit
+            layers = [
+                pdk.Layer(
+                    "GeoJsonLayer",
+                    data=layer.feature_collection,
+                    get_fill_color=[255, 0, 0, 51],
+                    get_line_color=[176, 0, 0],
+                    line_width_min_pixels=0.2,
+                    pickable=True,
+                ),
+                pdk.Layer(
+                    "GeoJsonLayer",
+                    data=layer.select(mun_codes),
+                    get_fill_color=[74, 196, 35, 128],
+                    get_line_color=[28, 87, 39],
+                    line_width_min_pixels=0.5,
+                    pickable=True,
+                ),
+            ]
+
+            # Display the map
+            st.pydeck_chart(
+                pdk.Deck(
+                    layers=layers,
+                    initial_view_state=view_state,
+                    map_style="light",
+                    tooltip={"text": "{nome}"},
+                ),
+                height=600,
+                key="mapaBase",
+            )
+        except Exception as e:
+            st.error(f"Erro ao carregar o mapa: {e}")
+
+    @staticmethod
+    def render_shared_memory(memory_usage):
+        """
+        Show the memory of the reference data shared by all sessions, which is
+        what each additional session saves by not loading its own copy
+
+        Args:
+            memory_usage: Bytes per component, from DataProcessor.memory_usage
+        """
+        with st.sidebar.expander("Memória compartilhada", expanded=False):
+            for component, nbytes in memory_usage.items():
+                st.caption(f"{component}: {nbytes / 2**20:.1f} MB")
+            st.metric(
+                "Economia por sessão",
+                value=f"{sum(memory_usage.values()) / 2**20:.1f} MB",
+            )
+
+    @staticmethod
+    def render_metrics(metrics):
+        """
+        Show the timings of the instrumented functions in this rerun, with the
+        accumulated measurements for download
+
+        Args:
+            metrics: MetricsRegistry, after start_run at the top of the script
+        """
+        with st.sidebar.expander("Desempenho", expanded=False):
+            run_timings = metrics.run_timings()
+            if run_timings:
+                df_timings = pd.DataFrame(
+                    run_timings, columns=["Função", "Segundos", "Linhas"]
+                )
+                st.dataframe(df_timings, hide_index=True)
+            else:
+                st.caption("Nenhuma função medida nesta execução.")
+            st.download_button(
+                "Métricas (JSON)",
+                metrics.to_json(),
+                file_name="metricas.json",
+                mime="application/json",
+            )
+            st.download_button(
+                "Métricas (Prometheus)",
+                metrics.to_prometheus(),
+                file_name="metricas.prom",
+                mime="text/plain",
+            )
+
+    @staticmethod
+    def render_pending(label, previous):
+        """
+        Show that a stage is being computed in the background
+
+        Args:
+            label: What is being computed, e.g. "o ônus"
+            previous: Whether the previous result is shown meanwhile
+        """
+        if previous:
+            st.caption(f"⏳ Atualizando {label}... exibindo o resultado anterior.")
+        else:
+            st.info(f"Calculando {label}...", icon="⏳")
 
     @staticmethod
     def render_onus_controls(df_data):